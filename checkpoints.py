@@ -0,0 +1,46 @@
+import os
+import pickle
+import hashlib
+
+class StageCheckpoints:
+    #saves the output of each stage of the calibration pipeline to checkpoint_dir, keyed on a hash of the stage's inputs. 
+    #When a stage is run again with the same inputs, its saved output is loaded instead, so a re-run skips straight to the first stage whose inputs changed.
+    #checkpoint_dir=None turns checkpointing off (every stage is just run).
+    #
+    #Only the inputs are hashed, not the code, so delete the checkpoint folder after changing how a stage is calculated.
+    def __init__(self, checkpoint_dir=None):
+        self.checkpoint_dir = checkpoint_dir
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(inputs):
+        #hash of the pickled inputs (numpy arrays, dictionaries, OffsetTables and other picklable objects)
+        return hashlib.sha1(pickle.dumps(inputs, protocol=4)).hexdigest()
+
+    def path(self, name, key):
+        return os.path.join(self.checkpoint_dir, f"{name}_{key}.pkl")
+
+    def run(self, name, func, *args, key_inputs=None, **kwargs):
+        #returns func(*args, **kwargs), loading it from the checkpoint for name if one was saved with the same inputs.
+        #key_inputs - what the output depends on (default: args and kwargs). Settings that don't change the output (e.g. number of workers) should be left out
+        if self.checkpoint_dir is None:
+            return func(*args, **kwargs)
+        if key_inputs is None:
+            key_inputs = (args, kwargs)
+        path = self.path(name, self.make_key(key_inputs))
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as fp:
+                    output = pickle.load(fp)
+                print(f"Loaded {name} from checkpoint ({os.path.basename(path)})")
+                return output
+            except Exception as e:    #e.g. truncated file, or a class pickled as __main__.OffsetTable that can't be found from this run (AttributeError/ImportError)
+                print(f"Could not load {name} checkpoint ({e}), running stage again")
+
+        output = func(*args, **kwargs)
+        temp_path = path + f".{os.getpid()}.tmp"
+        with open(temp_path, "wb") as fp:
+            pickle.dump(output, fp, protocol=4)
+        os.replace(temp_path, path)    #only finished checkpoints are ever seen
+        return output
@@ -0,0 +1,460 @@
+import numpy as np
+import pydicom
+import os
+import hashlib
+import inspect
+import operator
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import zoom, gaussian_filter
+
+def get_top_median(img, num=20000, skip=20000):
+    #this function returns the median of the top num of pixels in an image, not counting the hottest skip pixels (there can be errors with broken pixels)
+    #Only the rank window is needed, so a partial sort (np.partition) is used to pull it out rather than sorting every pixel
+    pixels = np.ravel(img)
+    stop = pixels.size - skip    #rank window in ascending order is [stop - num, stop)
+    if stop <= 0:
+        return np.nan
+    start = max(stop - num, 0)
+    top = np.partition(pixels, start)[start:]    #everything from the start of the window up
+    if skip > 0:
+        top = np.partition(top, stop - start - 1)    #then drop the skipped hottest pixels
+    hottest = top[:stop - start]
+    return np.median(hottest)
+
+def normalize_by_top_median(img, num=20000, skip=20000, reference=None):
+    #this function normalizes an image by the median of the top num of pixels (after skipping the hottest skip pixels)
+    #reference - optional image to compute the median on instead, e.g. the frame before it was upsampled. The rank window is scaled by the ratio of pixel 
+    #counts, so it covers the same fraction of the field.
+    #The median of each image is memoized (see DerivedResults), so normalizing by the same reference again doesn't redo the partial sort.
+    return img / get_norm_median(img, num=num, skip=skip, reference=reference)
+
+def get_norm_median(img, num=20000, skip=20000, reference=None):
+    #the median normalize_by_top_median divides img by, e.g. to normalize only part of an image
+    if reference is None:
+        return derived_results.get(get_top_median, img, num=num, skip=skip)
+    scale = np.size(reference) / np.size(img)
+    return derived_results.get(get_top_median, reference, num=int(round(num*scale)), skip=int(round(skip*scale)))
+
+def refine_dark_centroid(img, centre, num, refine_zoom=4):
+    #sub-pixel refinement of the centre of a dark spot (e.g. a bead or BB) found as the centroid of its num darkest pixels. A small patch around centre is 
+    #upsampled (cubic) by refine_zoom, and the centroid of its num*refine_zoom**2 darkest pixels (the same area) is returned in img's pixel coordinates
+    half_width = int(np.ceil(np.sqrt(num))) + 4    #comfortably larger than a disk of num pixels
+    start = [max(int(round(c)) - half_width, 0) for c in centre]
+    stop = [min(int(round(c)) + half_width + 1, n) for c, n in zip(centre, img.shape)]
+    patch = zoom(np.asarray(img[start[0]:stop[0], start[1]:stop[1]], dtype=float), refine_zoom, order=3)
+    count = min(num * refine_zoom**2, patch.size - 1)
+    centre_pixels = np.nonzero(patch <= np.partition(patch, count, axis=None)[count])
+    #patch pixel o samples the crop at o * (n-1)/(m-1) (scipy zoom with grid_mode=False)
+    scales = [(b - a - 1) / (m - 1) for a, b, m in zip(start, stop, patch.shape)]
+    return np.array([a + np.mean(pixels)*scale for a, pixels, scale in zip(start, centre_pixels, scales)])
+
+class DerivedResults:
+    #in memory memo of results derived from an image (e.g. the isocentre bead location or the normalization constant), so asking again for the same result 
+    #of the same image doesn't redo the work. Results are keyed by the image object (not its pixel values) and the function and its parameters. 
+    #Arrays among the parameters (e.g. a normalization reference) are also keyed by identity, and are kept alive with the result so the key stays unique.
+    #
+    #An image's results are dropped when it is garbage collected. If an image is changed in place, invalidate it so its stale results aren't returned.
+    def __init__(self):
+        self.results = {}    #id(image) -> {key: (result, arrays in the parameters)}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, func, img, *args, **kwargs):
+        #returns func(img, *args, **kwargs), from the memo if it has already been worked out for img with the same parameters
+        args_bound = inspect.signature(func).bind(img, *args, **kwargs)
+        args_bound.apply_defaults()
+        params = list(args_bound.arguments.items())[1:]
+        key = repr((func.__module__, func.__qualname__, [(name, ("array", id(value)) if isinstance(value, np.ndarray) else value) for name, value in params]))
+        memo = self.results.get(id(img))
+        if memo is not None and key in memo:
+            self.hits += 1
+            return memo[key][0]
+
+        self.misses += 1
+        result = func(img, *args, **kwargs)
+        if memo is None:
+            try:
+                weakref.finalize(img, self.results.pop, id(img), None)
+            except TypeError:    #e.g. a list, which can't be tracked, so its results aren't kept
+                return result
+            memo = self.results[id(img)] = {}
+        memo[key] = (result, [value for _, value in params if isinstance(value, np.ndarray)])
+        return result
+
+    def invalidate(self, img=None):
+        #drops the results of one image, or of every image if img is None
+        if img is None:
+            self.results.clear()
+        else:
+            self.results.pop(id(img), None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "images": len(self.results), "results": sum(len(memo) for memo in self.results.values())}
+
+    def report(self):
+        stats = self.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups > 0 else 0
+        print(f"Derived results: {stats['hits']} hits, {stats['misses']} misses ({round(100*hit_rate)}% hit rate), {stats['results']} results held for {stats['images']} images")
+
+derived_results = DerivedResults()    #shared memo used by the image functions
+
+def read_image_header(img_path):
+    #reads only the header of a dicom image (pixel data isn't decoded) and returns the fields used to sort the images:
+    #gantry angle (300A,011E), collimator angle (300A,0120), imager location (3002,000D) and jaw positions (3002,0030). Missing fields are None
+    meta = pydicom.dcmread(img_path, stop_before_pixels=True)
+    entry = {"path": img_path, "uid": str(meta.get("SOPInstanceUID", "")), "gantry": None, "coll": None, "imager_location": None, "jaws_x": None, "jaws_y": None}
+    try:
+        entry["gantry"] = round(float(meta[0x300A,0x011E].value)) % 360
+    except KeyError:
+        pass
+    try:
+        entry["coll"] = round(float(meta[0x300A,0x0120].value)) % 360
+    except KeyError:
+        pass
+    try:
+        entry["imager_location"] = round(float(meta[0x3002,0x000D].value[2]))
+    except (KeyError, IndexError, TypeError):
+        pass
+    try:
+        entry["jaws_x"] = [float(val) for val in meta[0x3002,0x0030][0][0x300A,0x00B6][0][0x300A,0X011C].value]
+        entry["jaws_y"] = [float(val) for val in meta[0x3002,0x0030][0][0x300A,0x00B6][1][0x300A,0X011C].value]
+    except (KeyError, IndexError):
+        pass
+    return entry
+
+def index_image_folder(img_folder):
+    #header only pass over every image in a folder, giving a manifest (list of header entries from read_image_header, sorted by file name) 
+    #that the later stages use to find images. Pixel data is only loaded when needed with load_pixels.
+    return [read_image_header(os.path.join(img_folder, img_path)) for img_path in sorted(os.listdir(img_folder))]
+
+def load_pixels(entry):
+    #decodes the pixel data for a manifest entry
+    return pydicom.dcmread(entry["path"]).pixel_array
+
+def drop_incomplete_entries(manifest, fields, name="image"):
+    #leaves out (and reports) manifest entries missing any of the header fields a stage sorts images by (e.g. an image without jaw positions), 
+    #so they are skipped rather than failing later. returns the remaining entries
+    complete = []
+    for entry in manifest:
+        missing = [field for field in fields if entry[field] is None]
+        if missing:
+            print(f"Skipping {name} {os.path.basename(entry['path'])}: no {', '.join(missing)} in its header")
+        else:
+            complete.append(entry)
+    return complete
+
+def check_manifest(manifest, key_func, expected_count=1, expected_keys=None, name="image"):
+    #flags duplicate or missing acquisitions in a manifest before any pixel data is processed.
+    #key_func maps a manifest entry to the acquisition it belongs to (e.g. (gantry, collimator)), expected_count is the number of images expected per acquisition
+    #and expected_keys is the list of acquisitions that must be present.
+    #returns a dictionary with the "duplicates" (key --> image paths) and "missing" (list of keys) acquisitions, which are also printed
+    images = {}
+    for entry in manifest:
+        images.setdefault(key_func(entry), []).append(entry["path"])
+
+    duplicates = {key: paths for key, paths in images.items() if len(paths) > expected_count}
+    missing = [key for key in (expected_keys or []) if len(images.get(key, [])) < expected_count]
+    for key, paths in duplicates.items():
+        print(f"Found {len(paths)} {name}s for {key} (expected {expected_count}): {[os.path.basename(path) for path in paths]}")
+    for key in missing:
+        print(f"Found {len(images.get(key, []))} {name}s for {key} (expected {expected_count})")
+
+    return {"duplicates": duplicates, "missing": missing}
+
+def get_half_means(entry, step=4):
+    #mean pixel value of the [left, right, top, bottom] halves of an image, from a thumbnail of the decoded frame (every step-th pixel) rather than the 
+    #preprocessed image. Normalizing, smoothing and zooming barely change these means, so the thumbnail is enough to e.g. tell which jaw is closed
+    thumbnail = load_pixels(entry)[::step, ::step]
+    y_range, x_range = thumbnail.shape
+    return np.array([np.mean(thumbnail[:, :int(x_range/2)]), np.mean(thumbnail[:, int(x_range/2):]), np.mean(thumbnail[:int(y_range/2), :]), np.mean(thumbnail[int(y_range/2):, :])])
+
+def preprocess_image(entry, zoom_size=2, sigma=3, num=20000, skip=20000):
+    #decodes a manifest entry and applies the standard chain: normalize by the top median (num, skip), smoothen with a gaussian filter and zoom (cubic)
+    img = load_pixels(entry)
+    img = normalize_by_top_median(img, num=num, skip=skip)
+    img = gaussian_filter(img, sigma=sigma, order=0)    #smoothen the image
+    img = zoom(img, zoom=zoom_size, order=3)
+    return img
+
+def iter_pipeline(func, tasks, workers=1, max_in_flight=None, cache=None):
+    #producer/consumer pipeline: yields func(*task) for each task (a tuple of arguments), in the same order as tasks.
+    #tasks are run in a pool of worker processes (workers=None uses all cores, 1 runs serially in this process), so file reading in one worker overlaps with 
+    #preprocessing in the others. At most max_in_flight tasks (default 2 per worker) are submitted but not yet consumed, which caps the number of 
+    #decoded images held in memory. func must be a module level function so it can be sent to the workers.
+    #cache - optional ImageCache. Tasks (whose first argument is a manifest entry) already in the cache are read from disk rather than run, and new results are stored
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    def run_serially(tasks):
+        for task in tasks:
+            key = cache.make_key(func, task) if cache is not None else None
+            img = cache.get(key) if cache is not None else None
+            if img is None:
+                img = func(*task)
+                if cache is not None:
+                    img = cache.put(key, img)
+            yield img
+
+    tasks = iter(tasks)
+    if workers <= 1:
+        yield from run_serially(tasks)
+        return
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    except OSError as e:
+        print(f"Could not start worker processes ({e}), processing images serially")
+        yield from run_serially(tasks)
+        return
+
+    def collect(key, result):
+        #cached images are queued as arrays, others as futures
+        if not hasattr(result, "result"):
+            return result
+        if cache is None:
+            return result.result()
+        return cache.put(key, result.result())
+
+    with executor:
+        in_flight = deque()
+        for task in tasks:
+            key = cache.make_key(func, task) if cache is not None else None
+            img = cache.get(key) if cache is not None else None
+            in_flight.append((key, img if img is not None else executor.submit(func, *task)))
+            if len(in_flight) >= max_in_flight:
+                yield collect(*in_flight.popleft())
+        while in_flight:
+            yield collect(*in_flight.popleft())
+
+class ImageCache:
+    #persistent on disk cache of preprocessed images. Each image is stored as a float32 .npy file named by a hash of the source image 
+    #(SOPInstanceUID, or a hash of the file if it has none) and the preprocessing function and its parameters, so changing e.g. sigma or the zoom factor
+    #gives a new entry rather than a stale one. Cached images are memory mapped (copy on write) when read.
+    #Results that aren't images (e.g. an edge position measured in the workers) are stored as they are, at full precision.
+    #RoiImages (e.g. just the strips through isocentre) are stored as float32 .npz files of their regions, which are read in full.
+    #
+    #max_bytes caps the size of the cache folder; the least recently used images are deleted once it is exceeded.
+    #On Windows a file can't be replaced or deleted while an image read from it is still memory mapped; such files are skipped and retried at the next eviction.
+    def __init__(self, cache_dir, max_bytes=10*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.evict()    #in case max_bytes was lowered since the last run
+
+    def make_key(self, func, task):
+        #key for func(*task), where task[0] is a manifest entry. Default arguments are included so the key records every preprocessing parameter
+        entry = task[0]
+        source = entry.get("uid") or self.file_hash(entry["path"])
+        args = inspect.signature(func).bind(*task)
+        args.apply_defaults()
+        params = [(name, value) for name, value in args.arguments.items() if value is not entry]
+        return hashlib.sha1(repr((source, func.__name__, params)).encode()).hexdigest()
+
+    @staticmethod
+    def file_hash(path):
+        sha = hashlib.sha1()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(1024**2), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def path(self, key, ext=".npy"):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key):
+        #returns the cached image (memory mapped, or a RoiImage) or None
+        path = self.path(key)
+        try:
+            if os.path.exists(self.path(key, ".npz")):
+                path = self.path(key, ".npz")
+                img = RoiImage.load(path)
+            else:
+                img = np.load(path, mmap_mode="c")
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        os.utime(path)    #mark as recently used
+        self.hits += 1
+        return img
+
+    def put(self, key, img):
+        #stores an image as float32 and returns the cached (memory mapped) copy, so later runs see exactly the same values
+        if isinstance(img, RoiImage):
+            path = self.path(key, ".npz")
+            img = img.astype(np.float32)
+        else:
+            path = self.path(key)
+            img = np.asarray(img, dtype=np.float32 if np.ndim(img) > 1 else None)
+        temp_path = path + f".{os.getpid()}.tmp"
+        with open(temp_path, "wb") as fp:
+            if isinstance(img, RoiImage):
+                img.save(fp)
+            else:
+                np.save(fp, img)
+        try:
+            os.replace(temp_path, path)
+        except OSError:    #an earlier copy is still mapped (Windows), so keep that file and return the image from memory
+            os.remove(temp_path)
+            return img
+        self.evict()
+        if not os.path.exists(path):    #image is larger than the whole cache
+            return img
+        if isinstance(img, RoiImage):
+            return RoiImage.load(path)
+        return np.load(path, mmap_mode="c")
+
+    def files(self):
+        #[(last used time, size, path)] of cached images, least recently used first
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy") or name.endswith(".npz"):
+                file_stat = os.stat(os.path.join(self.cache_dir, name))
+                files.append((file_stat.st_mtime, file_stat.st_size, os.path.join(self.cache_dir, name)))
+        return sorted(files)
+
+    def size(self):
+        return sum(size for _, size, _ in self.files())
+
+    def evict(self):
+        #deletes least recently used images until the cache fits in max_bytes
+        files = self.files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:    #still memory mapped (Windows), try again at the next eviction
+                continue
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        files = self.files()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "images": len(files), "bytes": sum(size for _, size, _ in files)}
+
+    def report(self):
+        stats = self.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups > 0 else 0
+        print(f"Image cache ({self.cache_dir}): {stats['hits']} hits, {stats['misses']} misses ({round(100*hit_rate)}% hit rate), {stats['evictions']} evicted, " 
+              f"{stats['images']} images, {round(stats['bytes']/1024**2, 1)} / {round(self.max_bytes/1024**2, 1)} MB")
+
+class RoiImage:
+    #an image of which only some regions (e.g. the strips through isocentre that the edge finding reads) are kept. It can be sliced like the full image, 
+    #as long as the requested region lies inside one of the kept regions, and the slice is a view into that region's array.
+    #rois is a list of (row_slice, col_slice) in the full image's pixel coordinates
+    def __init__(self, img, rois, dtype=np.float32):
+        self.shape = np.shape(img)
+        self.dtype = np.dtype(dtype)
+        self.regions = []
+        for roi in rois:
+            bounds = tuple(roi_slice.indices(n)[:2] for roi_slice, n in zip(roi, self.shape))
+            self.regions.append((bounds, np.array(img[tuple(slice(start, stop) for start, stop in bounds)], dtype=dtype)))
+
+    @classmethod
+    def from_regions(cls, shape, rois, regions, dtype=np.float32):
+        #makes a RoiImage from regions that were computed on their own (e.g. by preprocess_rois), without the full image. 
+        #regions[i] is the full image's [rois[i]], for an image of the given shape
+        roi_img = cls.__new__(cls)
+        roi_img.shape = tuple(shape)
+        roi_img.dtype = np.dtype(dtype)
+        roi_img.regions = []
+        for roi, region in zip(rois, regions):
+            bounds = tuple(roi_slice.indices(n)[:2] for roi_slice, n in zip(roi, roi_img.shape))
+            if np.shape(region) != tuple(stop - start for start, stop in bounds):
+                raise ValueError(f"Region of shape {np.shape(region)} doesn't match its roi {bounds}")
+            roi_img.regions.append((bounds, np.array(region, dtype=dtype)))
+        return roi_img
+
+    @property
+    def rois(self):
+        return [tuple(slice(start, stop) for start, stop in bounds) for bounds, _ in self.regions]
+
+    def astype(self, dtype):
+        return RoiImage.from_regions(self.shape, self.rois, [region for _, region in self.regions], dtype=dtype)
+
+    def save(self, fp):
+        #writes the image shape and the kept regions to an .npz file (see load)
+        np.savez(fp, shape=np.array(self.shape), bounds=np.array([bounds for bounds, _ in self.regions]), 
+                 **{f"region_{i}": region for i, (_, region) in enumerate(self.regions)})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            rois = [tuple(slice(int(start), int(stop)) for start, stop in bounds) for bounds in data["bounds"]]
+            regions = [data[f"region_{i}"] for i in range(len(rois))]
+            return cls.from_regions(data["shape"], rois, regions, dtype=regions[0].dtype if regions else np.float32)
+
+    @property
+    def nbytes(self):
+        return sum(region.nbytes for _, region in self.regions)
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        index = index + (slice(None),) * (len(self.shape) - len(index))
+        requested = []
+        for ind, n in zip(index, self.shape):
+            if isinstance(ind, slice):
+                start, stop, step = ind.indices(n)
+                if step != 1:
+                    raise IndexError("Only contiguous slices of a RoiImage are supported")
+                requested.append((start, max(start, stop)))
+            else:
+                ind = operator.index(ind)
+                ind = ind + n if ind < 0 else ind
+                requested.append((ind, ind + 1))
+
+        for bounds, region in self.regions:
+            if all(start >= roi_start and stop <= roi_stop for (start, stop), (roi_start, roi_stop) in zip(requested, bounds)):
+                local = tuple(slice(start - roi_start, stop - roi_start) if isinstance(ind, slice) else start - roi_start 
+                              for ind, (start, stop), (roi_start, _) in zip(index, requested, bounds))
+                return region[local]
+        raise IndexError(f"Region {requested} of the image was not kept (kept regions: {[bounds for bounds, _ in self.regions]})")
+
+class ImageStore:
+    #converts preprocessed images to a compact form as they are kept (e.g. in the nested image dictionaries) and keeps count of the bytes held.
+    #dtype - type the images are kept as (float32 by default, half the size of the float64 images the preprocessing makes)
+    #roi_only - if True, images added with a list of rois keep only those regions (as a RoiImage) rather than the whole frame.
+    #RoiImages (e.g. from preprocess_rois) are always kept as they are, converted to dtype
+    #
+    #Bytes are counted from when an image is added until it is garbage collected, so current_bytes is what is held right now and peak_bytes the most held at once.
+    def __init__(self, dtype=np.float32, roi_only=False):
+        self.dtype = np.dtype(dtype)
+        self.roi_only = roi_only
+        self.images = 0
+        self.current_bytes = 0
+        self.peak_bytes = 0
+
+    def add(self, img, rois=None):
+        #returns the image to keep: img as dtype, or a RoiImage of the rois (a list of (row_slice, col_slice)) if roi_only is set and rois are given
+        if isinstance(img, RoiImage):
+            img = img.astype(self.dtype)
+        elif self.roi_only and rois is not None:
+            img = RoiImage(img, rois, dtype=self.dtype)
+        else:
+            img = np.asarray(img, dtype=self.dtype)
+        self.images += 1
+        self.current_bytes += img.nbytes
+        self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+        weakref.finalize(img, self._release, img.nbytes)
+        return img
+
+    def _release(self, nbytes):
+        self.images -= 1
+        self.current_bytes -= nbytes
+
+    def stats(self):
+        return {"images": self.images, "bytes": self.current_bytes, "peak_bytes": self.peak_bytes}
+
+    def report(self):
+        stats = self.stats()
+        print(f"Image store ({self.dtype.name}{', ROI only' if self.roi_only else ''}): {stats['images']} images, {round(stats['bytes']/1024**2, 1)} MB held, " 
+              f"{round(stats['peak_bytes']/1024**2, 1)} MB peak")
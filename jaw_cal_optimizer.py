@@ -1,54 +1,58 @@
 import pydicom
 import os
-from copy import deepcopy
 import numpy as np
 import matplotlib.pyplot as plt
 import csv
 import stat
 import math
-from scipy.ndimage import zoom, gaussian_filter
+from scipy.ndimage import zoom, gaussian_filter, map_coordinates
 import datetime
+import heapq
+from concurrent.futures import ProcessPoolExecutor
 from lrfc_test import lrfc
+from image_utils import normalize_by_top_median, index_image_folder, load_pixels, check_manifest, drop_incomplete_entries, preprocess_image, get_half_means, iter_pipeline, ImageCache, ImageStore, derived_results, get_norm_median, refine_dark_centroid, RoiImage
+from checkpoints import StageCheckpoints
 def find_half_intensity_pixel(array):
     #This function takes a 1 or 2d array, and will find the interpolated 0.5 pixel value index along each row or column (the shortest axis)
     #and then return the average value. 
     #For example, if I have a 1d array, it'll just return the interpolated 0.5 value index. 
     #If i have a 100 x 3000 array, I will find the 0.5 index along the 100 rows and return the average value.
+    #A 3d array is treated as a stack of same sized 2d strips (e.g. from several images), and an array with the average value for each strip is returned.
+    #
+    #All rows/columns are done at once: the pixel closest to 0.5 is found along each line, and the crossing is interpolated with the next pixel if it is 
+    #on the other side of 0.5, otherwise with the previous pixel. Lines with neither neighbour on the other side of 0.5 are skipped.
     im_shape = array.shape
     if len(im_shape) == 1:
         return np.interp(0.5, np.arange(len(array)), array)
-    elif len(im_shape) == 2:
-        if im_shape[0] < im_shape[1]:
-            vals = []
-            for i in range(im_shape[0]):
-                ind = np.argmin(abs(array[i,:] - 0.5))
-                if array[i,ind] < 0.5:
-                    if array[i,ind+1] > 0.5:
-                        vals.append(ind + (0.5-array[i,ind])/(array[i,ind+1]-array[i,ind])) 
-                    elif array[i,ind-1] > 0.5:
-                        vals.append(ind-1+(0.5-array[i,ind-1])/(array[i,ind]-array[i,ind-1]))
-                elif array[i,ind] > 0.5:
-                    if array[i,ind+1] < 0.5:
-                        vals.append(ind+(0.5-array[i,ind])/(array[i,ind+1]-array[i,ind]))
-                    elif array[i,ind-1] < 0.5:
-                        vals.append(ind-1+(0.5-array[i,ind-1])/(array[i,ind]-array[i,ind-1]))
-            return np.mean(vals)
-
-        elif im_shape[1] < im_shape[0]:
-            vals = []
-            for i in range(im_shape[1]):
-                ind = np.argmin(abs(array[:,i] - 0.5))
-                if array[ind,i] < 0.5:
-                    if array[ind+1,i] > 0.5:
-                        vals.append(ind+(0.5-array[ind,i])/(array[ind+1,i]-array[ind,i]))
-                    elif array[ind-1,i] > 0.5:
-                        vals.append(ind-1+(0.5-array[ind-1,i])/(array[ind,i]-array[ind-1,i]))
-                elif array[ind,i] > 0.5:
-                    if array[ind+1,i] < 0.5:
-                        vals.append(ind+(0.5-array[ind,i])/(array[ind+1,i]-array[ind,i]))
-                    elif array[ind-1,i] < 0.5:
-                        vals.append(ind-1+(0.5-array[ind-1,i])/(array[ind,i]-array[ind-1,i]))
-            return np.mean(vals)
+
+    strips = array if len(im_shape) == 3 else array[None]
+    if strips.shape[1] < strips.shape[2]:
+        lines = strips    #find crossing along each row
+    elif strips.shape[2] < strips.shape[1]:
+        lines = strips.transpose(0, 2, 1)    #find crossing along each column
+    else:
+        return None
+    line_length = lines.shape[2]
+
+    ind = np.argmin(abs(lines - 0.5), axis=2)
+    closest = np.take_along_axis(lines, ind[:,:,None], axis=2)[:,:,0]
+    if np.any((ind == line_length - 1) & (closest != 0.5)):
+        raise IndexError(f"index {line_length} is out of bounds for lines of length {line_length}")
+    next_pixel = np.take_along_axis(lines, np.minimum(ind + 1, line_length - 1)[:,:,None], axis=2)[:,:,0]
+    prev_pixel = np.take_along_axis(lines, ((ind - 1) % line_length)[:,:,None], axis=2)[:,:,0]    #ind - 1 = -1 wraps around to the last pixel
+
+    below = closest < 0.5
+    above = closest > 0.5
+    use_next = (below & (next_pixel > 0.5)) | (above & (next_pixel < 0.5))
+    use_prev = ~use_next & ((below & (prev_pixel > 0.5)) | (above & (prev_pixel < 0.5)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vals = np.where(use_next, ind + (0.5-closest)/(next_pixel-closest), ind-1+(0.5-prev_pixel)/(closest-prev_pixel))
+    found = use_next | use_prev
+
+    means = np.array([np.mean(strip_vals[strip_found]) for strip_vals, strip_found in zip(vals, found)])
+    if len(im_shape) == 2:
+        return means[0]
+    return means
     
 def define_encoder_dict(unit=2, date=None):
     #this function initializes the dictionary of jaw positions --> encoder values. 
@@ -72,13 +76,42 @@ def round_to_point_five(x):
     #rounds value to nearest 0.5
     return round(round(2*x)/2,1)
 
-def normalize_by_top_median(img, num=20000):
-    #this function normalizes an image by the median of the top num of pixels
-    flattened = deepcopy(img).flatten()
-    sorted_pixels = np.sort(flattened)[::-1]
-    hottest = sorted_pixels[20000:20000+num]    #don't use hottest 20,000 pixels (there can be errors with broken pixels)
-    med=np.median(hottest)
-    return  img / med
+def get_zoomed_shape(shape, zoom_size):
+    #shape of an image after scipy's zoom
+    return tuple(int(round(n*zoom_size)) for n in shape)
+
+def preprocess_rois(img, rois, zoom_size=2, sigma=3, margin=40):
+    #this function does the same normalize --> smooth --> zoom preprocessing used when loading images, but only for the given regions of interest
+    #rather than the whole frame (only narrow strips around the isocentre/jaw edges are used in most places).
+    #
+    #rois is a list of (row_slice, col_slice) in zoomed pixel coordinates, e.g. (slice(iso[0]-100, iso[0]+100), slice(0, 2250)), and a list of arrays equal to
+    #zoom(gaussian_filter(normalize_by_top_median(img), sigma), zoom_size, order=3)[row_slice, col_slice] is returned.
+    #
+    #Each roi is mapped back to the raw image and cropped with a margin (raw pixels) for the gaussian kernel (4 sigma) and the cubic spline prefilter 
+    #(whose influence drops by ~4x per pixel), so values inside the roi match the full frame result. At the image edges the crop stops at the edge,
+    #so the filters see the same boundary as they do for the full frame.
+    img = normalize_by_top_median(img)
+    zoomed_shape = get_zoomed_shape(img.shape, zoom_size)
+    #output pixel o samples input coordinate o * (n-1)/(m-1) (scipy zoom with grid_mode=False)
+    scales = [(n-1)/(m-1) for n, m in zip(img.shape, zoomed_shape)]
+
+    roi_imgs = []
+    for roi in rois:
+        crop_bounds = []
+        out_coords = []
+        for roi_slice, n, m, scale in zip(roi, img.shape, zoomed_shape, scales):
+            start, stop, _ = roi_slice.indices(m)
+            stop = max(start, stop)
+            crop_start = max(int(np.floor(start*scale)) - margin, 0)
+            crop_stop = min(int(np.ceil((stop-1)*scale)) + 1 + margin, n)
+            crop_bounds.append(slice(crop_start, crop_stop))
+            out_coords.append(np.arange(start, stop)*scale - crop_start)
+
+        crop = gaussian_filter(img[tuple(crop_bounds)], sigma=sigma, order=0)    #smoothen the image
+        coords = np.meshgrid(*out_coords, indexing="ij")
+        roi_imgs.append(map_coordinates(crop, coords, order=3, mode="constant"))
+
+    return roi_imgs
 
 def which_jaw_measuring(jaws_x, jaws_y):
     #this function determines which of the 4 jaws is the one being measured for encoder positions. This is determined by finding the one jaw who isn't at the default position of 12
@@ -91,8 +124,47 @@ def which_jaw_measuring(jaws_x, jaws_y):
     elif round(abs(jaws_y[1])) != 120:
         return "y2"
 
-def fit_encoder_vs_pixel_funcs(date, img_folder, iso_img_path, unit_num, optimal_cal,epid_position=1.086):
+def encoder_image_key(entry):
+    #(measured jaw, nominal jaw position in cm) of an encoder sweep image, from its manifest entry
+    current_jaw = which_jaw_measuring(entry["jaws_x"], entry["jaws_y"])
+    if current_jaw is None:
+        return None
+    jaw_pos = entry["jaws_x"][0] if current_jaw == "x1" else entry["jaws_x"][1] if current_jaw == "x2" else entry["jaws_y"][0] if current_jaw == "y1" else entry["jaws_y"][1]
+    return (current_jaw, round_to_point_five(round(abs(jaw_pos)/10,1)))
+
+def preprocess_encoder_roi(entry, roi):
+    #decodes an encoder sweep image and preprocesses only the strip over the measured jaw's edge (run in the iter_pipeline workers)
+    return preprocess_rois(load_pixels(entry), [roi], zoom_size=3)[0]
+
+def measure_encoder_edge(entry, roi):
+    #finds the measured jaw's edge pixel (within the strip) of an encoder sweep image. Run in the iter_pipeline workers, so only the edge position comes back 
+    #to the main process and each frame and strip is dropped as soon as it's measured
+    return find_half_intensity_pixel(preprocess_encoder_roi(entry, roi))
+
+def check_junction_manifest(manifest):
+    #drops junction images without a gantry/collimator angle and flags duplicate or missing acquisitions, returning the usable manifest
+    manifest = drop_incomplete_entries(manifest, ["gantry", "coll"], name="junction image")
+    #each gantry/collimator setting should have 5 images (isocentre + 4 closed jaws), at least at the angles used for the junctions
+    check_manifest(manifest, lambda entry: (entry["gantry"], entry["coll"]), expected_count=5, expected_keys=[(g, c) for g in [0, 50, 130, 180, 230, 310] for c in [0, 90]], name="junction image")
+    return manifest
+
+def check_jaw_manifest(manifest):
+    #drops jaw position images without jaw positions and flags duplicate acquisitions, returning the usable manifest
+    manifest = drop_incomplete_entries(manifest, ["jaws_x", "jaws_y"], name="jaw position image")
+    check_manifest(manifest, lambda entry: (tuple(entry["jaws_x"]), tuple(entry["jaws_y"])), name="jaw position image")
+    return manifest
+
+def check_encoder_manifest(manifest):
+    #drops encoder sweep images without jaw positions and flags duplicate acquisitions, returning the usable manifest
+    manifest = drop_incomplete_entries(manifest, ["jaws_x", "jaws_y"], name="encoder image")
+    check_manifest(manifest, encoder_image_key, name="encoder image")
+    return manifest
+
+def fit_encoder_vs_pixel_funcs(date, img_folder, iso_img_path, unit_num, optimal_cal,epid_position=1.086, manifest=None, workers=1, cache=None):
     #this function finds the epid pixels corresponding to each jaw position in img_dict, and then fits a curve to those pixel values with the jaw encoder readouts
+    #manifest - checked header index of img_folder (from check_encoder_manifest), made and checked here if not given
+    #workers - number of processes used to decode and preprocess the images (see iter_pipeline)
+    #cache - optional ImageCache of preprocessed images
 
     encoder_dic = define_encoder_dict(unit_num, date)   #initialize dictionary which will hold jaw positions, encoders, pixels
     #get iso img
@@ -101,51 +173,48 @@ def fit_encoder_vs_pixel_funcs(date, img_folder, iso_img_path, unit_num, optimal
     img = normalize_by_top_median(img)   #normalize image
     img = gaussian_filter(img, sigma=3, order=0)    #smoothen the image
     iso_img = zoom(img, zoom=3, order=3)
-    iso = find_bead_location(iso_img, round_final=True, zoom_size=3)    #first get the pixel position of the isocentre
+    iso = find_bead_location(iso_img, round_final=True, zoom_size=3, norm_reference=img)    #first get the pixel position of the isocentre
 
-    for img_path in sorted(os.listdir(img_folder)):
-        
-        img_path = os.path.join(img_folder, img_path)
-        img_meta = pydicom.dcmread(img_path)
-        jaws_x = img_meta[0x3002,0x0030][0][0x300A,0x00B6][0][0x300A,0X011C].value
-        jaws_y = img_meta[0x3002,0x0030][0][0x300A,0x00B6][1][0x300A,0X011C].value
-        img = img_meta.pixel_array
-        img = normalize_by_top_median(img)
-        img = gaussian_filter(img, sigma=3, order=0)    #smoothen the image
-        img = zoom(img, zoom=3, order=3)
+    if manifest is None:
+        manifest = check_encoder_manifest(index_image_folder(img_folder))
+
+    #only the strip over the measured jaw's edge is needed, so only that region is smoothed and zoomed, and the workers return just the edge pixel. 
+    #Memory use doesn't grow with the number of images in the sweep
+    jaw_rois = {"x1": (slice(iso[0]-100, iso[0]+100), slice(0, 2250)), "x2": (slice(iso[0]-100, iso[0]+100), slice(1500, -1)),
+                "y1": (slice(1500, -1), slice(iso[1]-100, iso[1]+100)), "y2": (slice(0, 2250), slice(iso[1]-100, iso[1]+100))}
+    manifest = [entry for entry in manifest if which_jaw_measuring(entry["jaws_x"], entry["jaws_y"]) in jaw_rois]
+    tasks = [(entry, jaw_rois[which_jaw_measuring(entry["jaws_x"], entry["jaws_y"])]) for entry in manifest]
 
+    for entry, edge_pixel in zip(manifest, iter_pipeline(measure_encoder_edge, tasks, workers=workers, cache=cache)):
+        jaws_x = entry["jaws_x"]
+        jaws_y = entry["jaws_y"]
         current_jaw = which_jaw_measuring(jaws_x, jaws_y)
+
         if current_jaw == "x1":
         #x1:np.mean(np.argmin(abs(x2_profile - 0.5), axis=0))
-            x1_profile = deepcopy(img[iso[0]-100:iso[0]+100, 0:2250])
-            # plt.plot(x1_profile[50,:])
-            # plt.show()
             #determine centre as pixel with sharpest gradient
-            x1_pixel = find_half_intensity_pixel(x1_profile)
+            x1_pixel = float(edge_pixel)
             x1_displacement = round_to_point_five(round(abs(jaws_x[0])/10,1))#round((round(-4*(x1_pixel - iso[1]) * pixel_distance/2)/2),1)  #--> cm bc make negative to follow sign convention (positive if jaw crosses iso, negative if shy)     
             encoder_dic["x1"][x1_displacement]["pixel"] = x1_pixel
 
         elif current_jaw == "x2":
             #x2:
-            x2_profile = deepcopy(img[iso[0]-100:iso[0]+100, 1500:-1])
             #determine centre as pixel with sharpest gradient
-            x2_pixel = find_half_intensity_pixel(x2_profile)+1500
+            x2_pixel = float(edge_pixel)+1500
             x2_displacement = round_to_point_five(round(abs(jaws_x[1])/10,1))#round((round(4*(x2_pixel - iso[1]) * pixel_distance/2)/2),1)   #--> cm bc make negative to follow sign convention (positive if jaw crosses iso, negative if shy)     
             encoder_dic["x2"][x2_displacement]["pixel"] = x2_pixel
 
         if current_jaw == "y1":
             #y1:
-            y1_profile = deepcopy(img[1500:-1, iso[1]-100:iso[1]+100])
             #determine centre as pixel with sharpest gradient
-            y1_pixel = find_half_intensity_pixel(y1_profile) +1500
+            y1_pixel = float(edge_pixel) +1500
             y1_displacement = round_to_point_five(round(abs(jaws_y[0])/10,1))#round((round(4*(y1_pixel - iso[0]) * pixel_distance/2)/2),1)   #--> cm bc make negative to follow sign convention (positive if jaw crosses iso, negative if shy)     
             encoder_dic["y1"][y1_displacement]["pixel"] = y1_pixel
 
         if current_jaw == "y2":
             #y2:
-            y2_profile = deepcopy(img[0:2250, iso[1]-100:iso[1]+100])
             #determine centre as pixel with sharpest gradient
-            y2_pixel = find_half_intensity_pixel(y2_profile)
+            y2_pixel = float(edge_pixel)
             y2_displacement = round_to_point_five(round(abs(jaws_y[1])/10,1))#round((round(-4*(y2_pixel - iso[0]) * pixel_distance/2)/2),1)   #--> cm bc make negative to follow sign convention (positive if jaw crosses iso, negative if shy)            
             encoder_dic["y2"][y2_displacement]["pixel"] = y2_pixel
 
@@ -226,7 +295,7 @@ def fit_encoder_vs_pixel_funcs(date, img_folder, iso_img_path, unit_num, optimal
         ax[j].set_ylabel(f"{jaw} Jaw Encoder Value")
 
         #also get the predicted location of the locations 1,5,9,19 using the optimal calibration point as the origin
-        iso = find_bead_location(iso_img, round_final=False, zoom_size=3) #get unrounded iso
+        iso = find_bead_location(iso_img, round_final=False, zoom_size=3, norm_reference=img) #get unrounded iso
         fits = [fit_low, fit_mid, fit_high]
         p1, p5, p9, p19 = predict_opt_cal_locations(iso, jaw, optimal_cal, fits, epid_position=epid_position)
         if j == 0:
@@ -281,36 +350,52 @@ def predict_opt_cal_locations(iso, jaw, optimal_cal, fits, epid_position=1.18):
 
     return [round(p1), round(p5), round(p9), round(p19)]
 
-def sort_junc_img_dict(img_folder : str):
+def get_isocentre_rois(shape, half_width=20):
+    #regions of an image that the junction and jaw position offsets are measured from: a band of rows and a band of columns through the centre of the image
+    #covering the area the isocentre bead is searched for (see find_bead_location) plus the half width of the strips taken through it (see get_junction_strip)
+    row_start, row_stop = int(14*shape[0]/30) - half_width - 1, int(16*shape[0]/30) + half_width + 1
+    col_start, col_stop = int(14*shape[1]/30) - half_width - 1, int(16*shape[1]/30) + half_width + 1
+    return [(slice(max(row_start, 0), row_stop), slice(None)), (slice(None), slice(max(col_start, 0), col_stop))]
+
+def preprocess_isocentre_strips(entry, zoom_size=2, sigma=3):
+    #decodes a closed jaw (or jaw position) image and preprocesses only the strips through isocentre its edges are measured from (see get_isocentre_rois), 
+    #rather than smoothing and zooming the whole frame (see preprocess_rois). The strips only depend on the frame shape, so this can run in the 
+    #iter_pipeline workers. Returns a RoiImage in the zoomed image's pixel coordinates
+    img = load_pixels(entry)
+    zoomed_shape = get_zoomed_shape(img.shape, zoom_size)
+    rois = get_isocentre_rois(zoomed_shape)
+    return RoiImage.from_regions(zoomed_shape, rois, preprocess_rois(img, rois, zoom_size=zoom_size, sigma=sigma), dtype=np.float64)
+
+#closed jaw for each collimator angle given the darkest half of the image, in the order [left, right, top, bottom]
+junction_blocked_fields = {0: ["x1", "x2", "y2", "y1"], 90: ["y2", "y1", "x2", "x1"], 270: ["y1", "y2", "x1", "x2"]}
+
+def sort_junc_img_dict(img_folder : str, manifest=None, workers=1, cache=None, store=None, coll_angles=(0, 90), thumbnail_step=4):
     #first load images into a dictionary based on gantry angle and collimator angle
+    #manifest - checked header index of img_folder (from check_junction_manifest), made and checked here if not given
+    #workers - number of processes used to decode and preprocess the images (see iter_pipeline)
+    #cache - optional ImageCache of preprocessed images
+    #store - ImageStore the images are kept through (float32 by default). Only the strips through isocentre of the closed jaw images are preprocessed and 
+    #kept (see preprocess_isocentre_strips), the isocentre images are kept whole for the bead search.
+    #coll_angles - collimator angles to load (see get_junc_offsets). Images at other angles are skipped without reading their pixels
+    #thumbnail_step - decimation of the raw frames the closed jaw is found from (see get_half_means)
     imgs = {}    #initiate the image dictionary
-
-    #go through the image directory and sort and store images
-    for img_path in os.listdir(img_folder):
-        img_path = os.path.join(img_folder, img_path)
-        img_meta = pydicom.dcmread(img_path)
-        img = img_meta.pixel_array
-        img = normalize_by_top_median(img)
-        img = gaussian_filter(img, sigma=3, order=0)    #smoothen the image
-        img = zoom(img, zoom=2, order=3)
-
-        # plt.imshow(img, cmap="bone")
-        # plt.show()
-
-        # jaws = img_meta[0x3002,0x0030].value[0][0x300A, 0x00B6][0]
-        
-        gantry_angle = round(float(img_meta[0x300A,0x011E].value)) % 360
-
-        if gantry_angle not in imgs.keys():
-            imgs[gantry_angle] = {}
-
-        coll_angle = round(float(img_meta[0x300A, 0x0120].value)) % 360
-
-        if coll_angle not in imgs[gantry_angle].keys():
+    if store is None:
+        store = ImageStore()
+
+    if manifest is None:
+        manifest = check_junction_manifest(index_image_folder(img_folder))
+    manifest = [entry for entry in manifest if entry["coll"] in coll_angles]
+
+    #collimator positions not included in metadata, so determine closed jaw from lowest mean pixel intensity in each quarter blocked region.
+    #Only coarse intensities are needed, so this is done on a thumbnail of the raw frame and each image is routed before any preprocessing. 
+    #Only the images that are kept are preprocessed (a later image for the same gantry/collimator/jaw replaces an earlier one)
+    routes = {}    #(gantry, collimator, closed jaw or "iso") -> manifest entry
+    for entry, mean_blocked_pixels in zip(manifest, iter_pipeline(get_half_means, [(entry, thumbnail_step) for entry in manifest], workers=workers, cache=cache)):
+        gantry_angle = entry["gantry"]
+        coll_angle = entry["coll"]
+        if coll_angle not in imgs.setdefault(gantry_angle, {}):
             imgs[gantry_angle][coll_angle] = {}
 
-        imager_location = round(float(img_meta[0x3002, 0x000D].value[2]))    #get location of EPID receptor panel
-
         #old method (when position 0 was used for other images)
         #
         #
@@ -320,58 +405,32 @@ def sort_junc_img_dict(img_folder : str):
         #     continue
         #
         #
-        
-        #collimator positions not included in metadata, so determine closed jaw from lowest mean pixel intensity in each quarter blocked region
-        y_range, x_range = img.shape
-        #order of quarter regions is: [left, right, top, bottom]
-        mean_blocked_pixels = [np.mean(img[:, :int(x_range/2)]), np.mean(img[:, int(x_range/2):]), np.mean(img[:int(x_range/2), :]), np.mean(img[int(x_range/2):, :])]    #C0: x1, x2, y2, y1 / C90: y2, y1, x2, x1 
-        
-        min_region_index = np.argmin(mean_blocked_pixels)
-        
+
+        #order of quarter regions is: [left, right, top, bottom]   #C0: x1, x2, y2, y1 / C90: y2, y1, x2, x1 
         #if field is symmetric, then it is the isocentre image (no closed jaws)
         if (np.amin(mean_blocked_pixels)/np.amax(mean_blocked_pixels)) > 0.6: 
-            imgs[gantry_angle]["iso"] = img
-            #find_bead_location(img)
+            routes[(gantry_angle, None, "iso")] = entry   #using same image for both coll rotations
             continue
+        blocked_field = junction_blocked_fields[coll_angle][np.argmin(mean_blocked_pixels)]
+        routes[(gantry_angle, coll_angle, blocked_field)] = entry
 
-        blocked_field = ""
-
-        if coll_angle == 0:
-            if min_region_index == 0:
-                blocked_field = "x1"
-            if min_region_index == 1:
-                blocked_field = "x2"
-            if min_region_index == 2:
-                blocked_field = "y2"
-            if min_region_index == 3:
-                blocked_field = "y1"
-        elif coll_angle == 90:
-            if min_region_index == 0:
-                blocked_field = "y2"
-            if min_region_index == 1:
-                blocked_field = "y1"
-            if min_region_index == 2:
-                blocked_field = "x2"
-            if min_region_index == 3:
-                blocked_field = "x1"
-
-        elif coll_angle == 270:
-            if min_region_index == 0:
-                blocked_field = "y1"
-            if min_region_index == 1:
-                blocked_field = "y2"
-            if min_region_index == 2:
-                blocked_field = "x1"
-            if min_region_index == 3:
-                blocked_field = "x2"
-
-
-
-        imgs[gantry_angle][coll_angle][blocked_field] = img
+    #go through the routed images and preprocess and store them: whole frames for the isocentre images, only the strips through isocentre for the closed jaws
+    iso_routes = {key: entry for key, entry in routes.items() if key[2] == "iso"}
+    jaw_routes = {key: entry for key, entry in routes.items() if key[2] != "iso"}
+    for (gantry_angle, _, _), img in zip(iso_routes.keys(), iter_pipeline(preprocess_image, [(entry, 2, 3) for entry in iso_routes.values()], workers=workers, cache=cache)):
+        imgs[gantry_angle]["iso"] = store.add(img)
+    for (gantry_angle, coll_angle, blocked_field), img in zip(jaw_routes.keys(), iter_pipeline(preprocess_isocentre_strips, [(entry, 2, 3) for entry in jaw_routes.values()], workers=workers, cache=cache)):
+        imgs[gantry_angle][coll_angle][blocked_field] = store.add(img)
 
     return imgs
 
-def sort_jaw_img_dict(img_folder : str):
+def sort_jaw_img_dict(img_folder : str, manifest=None, workers=1, cache=None, store=None):
+    #manifest - checked header index of img_folder (from check_jaw_manifest), made and checked here if not given
+    #workers - number of processes used to decode and preprocess the images (see iter_pipeline)
+    #cache - optional ImageCache of preprocessed images
+    #store - ImageStore the images are kept through (float32 by default). Only the strips through isocentre are preprocessed and kept (see preprocess_isocentre_strips)
+    if store is None:
+        store = ImageStore()
 
     imgs = {}    #initiate the image dictionary
     imgs["x1"] = {}
@@ -380,16 +439,14 @@ def sort_jaw_img_dict(img_folder : str):
     imgs["y2"] = {}
 
 
+    if manifest is None:
+        manifest = check_jaw_manifest(index_image_folder(img_folder))
+
     #go through the image directory and sort and store images
-    for img_path in os.listdir(img_folder):
-        img_path = os.path.join(img_folder, img_path)
-        img_meta = pydicom.dcmread(img_path)
-        jaws_x = img_meta[0x3002,0x0030][0][0x300A,0x00B6][0][0x300A,0X011C].value
-        jaws_y = img_meta[0x3002,0x0030][0][0x300A,0x00B6][1][0x300A,0X011C].value
-        img = img_meta.pixel_array
-        img = normalize_by_top_median(img)
-        img = gaussian_filter(img, sigma=3, order=0)    #smoothen the image
-        img = zoom(img, zoom=2, order=3)
+    for entry, img in zip(manifest, iter_pipeline(preprocess_isocentre_strips, [(entry, 2, 3) for entry in manifest], workers=workers, cache=cache)):
+        jaws_x = entry["jaws_x"]
+        jaws_y = entry["jaws_y"]
+        img = store.add(img)
          
         #collimator positions not included in metadata, so determine closed jaw from lowest mean pixel intensity in each quarter blocked region
         y_range, x_range = img.shape
@@ -430,201 +487,162 @@ def sort_jaw_img_dict(img_folder : str):
 
     return imgs
 
-def get_junc_offsets(img_dict, unit_num):
+class OffsetTable:
+    #array backed table of jaw offsets from isocentre (mm) at each gantry angle, collimator angle and jaw, used in place of the nested offsets[g][c][jaw] dictionary.
+    #values[g_ind, c_ind, jaw_ind] holds the offsets (nan where there is no measurement) and iso[g_ind] holds the isocentre bead pixel location for each gantry angle.
+    #
+    #For existing code, table[g] gives a (read only) dictionary view of one gantry angle in the old format: {c: {jaw: offset}, "iso": [row, col]}
+    #
+    #values can also have leading sample axes (..., G, C, 4), e.g. a batch of perturbed tables for get_monte_carlo_shifts. get, relative and shifted and the 
+    #cost functions then work on every sample at once (the dictionary view is only for single tables)
+    jaws = ["x1", "x2", "y1", "y2"]
+
+    def __init__(self, gantry_angles, coll_angles, values=None, iso=None):
+        self.gantry_angles = list(gantry_angles)
+        self.coll_angles = list(coll_angles)
+        self._gantry_inds = {g: i for i, g in enumerate(self.gantry_angles)}
+        self._coll_inds = {c: i for i, c in enumerate(self.coll_angles)}
+        if values is None:
+            values = np.full((len(self.gantry_angles), len(self.coll_angles), len(self.jaws)), np.nan)
+        if iso is None:
+            iso = np.full((len(self.gantry_angles), 2), np.nan)
+        self.values = np.asarray(values, dtype=float)
+        self.iso = np.asarray(iso, dtype=float)
+
+    @classmethod
+    def from_dict(cls, offsets : dict):
+        #builds a table from the nested offset dictionary (as made by get_junc_offsets). Entries that aren't numbers (e.g. images left over when a jaw edge couldn't be found) are left as nan
+        gantry_angles = list(offsets.keys())
+        coll_angles = []
+        for g in gantry_angles:
+            coll_angles += [c for c in offsets[g].keys() if c != "iso" and c not in coll_angles]
+        table = cls(gantry_angles, coll_angles)
+        for g in gantry_angles:
+            for c in offsets[g].keys():
+                if c == "iso":
+                    table.iso[table._gantry_inds[g]] = offsets[g]["iso"]
+                    continue
+                for jaw in cls.jaws:
+                    if jaw in offsets[g][c] and isinstance(offsets[g][c][jaw], (int, float, np.integer, np.floating)):
+                        table.set(g, c, jaw, offsets[g][c][jaw])
+        return table
+
+    def index(self, g, c, jaw):
+        return self._gantry_inds[g], self._coll_inds[c], self.jaws.index(jaw)
+
+    def get(self, g, c, jaw):
+        return self.values[(Ellipsis,) + self.index(g, c, jaw)]
+
+    def set(self, g, c, jaw, offset):
+        self.values[(Ellipsis,) + self.index(g, c, jaw)] = offset
+
+    def relative(self):
+        #offsets relative to the g0c0 calibration position, for each jaw
+        return self.values - self.values[..., self._gantry_inds[0], self._coll_inds[0], None, None, :]
+
+    def shifted(self, shifts):
+        #returns a new table after moving the calibration point to shifts = (x1, x2, y1, y2) from isocentre. In service mode, jaws are calibrated at g0c0, 
+        #so the new offset is the difference in offset from the calibration position + the cal position offset from isocentre
+        return OffsetTable(self.gantry_angles, self.coll_angles, values=self.relative() + np.asarray(shifts, dtype=float), iso=self.iso.copy())
+
+    def to_dict(self):
+        return {g: self[g] for g in self.gantry_angles}
+
+    def keys(self):
+        return list(self.gantry_angles)
+
+    def __iter__(self):
+        return iter(self.gantry_angles)
+
+    def __contains__(self, g):
+        return g in self._gantry_inds
+
+    def __getitem__(self, g):
+        g_ind = self._gantry_inds[g]
+        gantry_offsets = {}
+        for c_ind, c in enumerate(self.coll_angles):
+            jaw_offsets = {jaw: float(self.values[g_ind, c_ind, j]) for j, jaw in enumerate(self.jaws) if not np.isnan(self.values[g_ind, c_ind, j])}
+            if jaw_offsets:
+                gantry_offsets[c] = jaw_offsets
+        if not np.any(np.isnan(self.iso[g_ind])):
+            gantry_offsets["iso"] = [float(self.iso[g_ind, 0]), float(self.iso[g_ind, 1])]
+        return gantry_offsets
+
+def as_offset_table(offsets):
+    #lets functions take either an OffsetTable or the nested offset dictionary
+    if isinstance(offsets, OffsetTable):
+        return offsets
+    return OffsetTable.from_dict(offsets)
+
+#jaw edges measured in the junction images at each collimator angle: (jaw, direction, sign). "vertical" edges are found along a strip of columns through 
+#isocentre (offset from the isocentre row), "horizontal" edges along a strip of rows (offset from the isocentre column). 
+#sign makes the offsets follow the convention of positive if the jaw doesn't reach isocentre, negative if it crosses it.
+junction_profile_specs = {0: [("y1", "vertical", 1), ("y2", "vertical", -1), ("x1", "horizontal", -1), ("x2", "horizontal", 1)],
+                          90: [("x1", "vertical", 1), ("x2", "vertical", -1), ("y2", "horizontal", -1), ("y1", "horizontal", 1)],
+                          270: [("x2", "vertical", 1), ("x1", "vertical", -1), ("y1", "horizontal", -1), ("y2", "horizontal", 1)]}
+
+def get_junction_strip(img, isocentre, direction, half_width=20):
+    #returns the strip of an image through isocentre used to find a jaw edge (a view, not a copy), turned so the edge runs along the columns
+    if direction == "vertical":
+        return img[:, round(isocentre[1])-half_width:round(isocentre[1])+half_width]
+    return img[round(isocentre[0])-half_width:round(isocentre[0])+half_width, :].T
+
+def find_strip_edges(strips):
+    #finds the jaw edge (0.5 crossing) in each strip of a 3d stack in one call. If a strip's edge can't be found, the strips are done one at a time 
+    #and the ones that fail are left as nan
+    try:
+        return find_half_intensity_pixel(strips)
+    except IndexError:
+        edges = np.full(strips.shape[0], np.nan)
+        for i, strip in enumerate(strips):
+            try:
+                edges[i] = find_half_intensity_pixel(strip)
+            except IndexError:
+                pass
+        return edges
+
+def get_junc_offsets(img_dict, unit_num, coll_angles=(0, 90)):
     #this function will determine the offset of each 1/4 blocked beam jaw with the isocentre (defined by bead in each phantom image at each gantry/coll setting)
     #values will be reported such that negative means the jaw passed over the iso, positive means it doesn't reach it. 
-    
-    #start by defining a dictionary of same format as img_dict that will hold the offsets.
-    offset_dict = deepcopy(img_dict)
-
-    
-    for g in img_dict.keys():    #go through all gantry angles
+    #
+    #The strips through every gantry/collimator/jaw image (see junction_profile_specs) are stacked and all the edges are found at once.
+    #coll_angles (default (0, 90)) - collimator angles to measure, e.g. (0, 90, 270) to include the c270 images
+    #
+    #returns an OffsetTable of the offsets (nan for missing images or edges that couldn't be found), with the isocentre bead location at each gantry angle.
+    #Offsets the cost function needs must be present for the optimization (see get_missing_cost_offsets)
+    offsets = OffsetTable(list(img_dict.keys()), coll_angles)
 
-        image = img_dict[g]["iso"]
+    strip_keys = []
+    strips = []
+    for g_ind, g in enumerate(img_dict.keys()):    #go through all gantry angles
         #start by getting the isocentre bead pixel location for each setting
-        offset_dict[g]["iso"] = find_bead_location(image, round_final=False)
-        
-        #start with c = 0 images
-        isocentre = offset_dict[g]["iso"]
-
-        #y1 - want profile through centre y along x
-        y1_profile = deepcopy(img_dict[g][0]["y1"][:, round(isocentre[1])-20:round(isocentre[1])+20])
-        y1_profile[0:int(y1_profile.shape[0]/4),:] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        y1_profile[int(3*y1_profile.shape[0]/4):,:] = 1
-        y1_offset = (find_half_intensity_pixel(y1_profile) - isocentre[0]) * 0.224/2   #make negative to follow sign convention (positive if jaw openy)     
-        offset_dict[g][0]["y1"] = y1_offset 
+        isocentre = find_bead_location(img_dict[g]["iso"], round_final=False)
+        offsets.iso[g_ind] = isocentre
 
-        #repeat for y2 jaw
-        y2_profile = deepcopy(img_dict[g][0]["y2"][:, round(isocentre[1])-20:round(isocentre[1])+20])
-        y2_profile[0:int(y2_profile.shape[0]/4),:] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        y2_profile[int(3*y2_profile.shape[0]/4):,:] = 1
-        y2_offset = -(find_half_intensity_pixel(y2_profile) - isocentre[0])* 0.224/2
-        offset_dict[g][0]["y2"] = y2_offset 
-        try:
-            #repeat for x1 jaw
-            x1_profile = deepcopy(img_dict[g][0]["x1"][round(isocentre[0])-20:round(isocentre[0])+20, :])
-            x1_profile[:,0:int(x1_profile.shape[1]/4)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-            x1_profile[:,int(3*x1_profile.shape[1]/4):] = 1
-            x1_offset = -(find_half_intensity_pixel(x1_profile) - isocentre[1])* 0.224/2
-            offset_dict[g][0]["x1"] = x1_offset  
-        except:
-            pass
-
-        #repeat for x2 jaw
-        try:
-            x2_profile = deepcopy(img_dict[g][0]["x2"][round(isocentre[0])-20:round(isocentre[0])+20, :])
-            x2_profile[:,0:int(x2_profile.shape[1]/4)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-            x2_profile[:,int(3*x2_profile.shape[1]/4):] = 1
-            x2_offset = (find_half_intensity_pixel(x2_profile) - isocentre[1])* 0.224/2
-            offset_dict[g][0]["x2"] = x2_offset 
-        except: pass
-
-        # fig, ax = plt.subplots(nrows=4, ncols=3, figsize=(17, 17))
-        # ax[0,0].set_title(f"Gantry Angle: {g}$^\circ$, Collimator Angle: {0}$^\circ$")
-        # ax[0,0].plot(y1_profile)
-        # ax[0,1].plot(y1_profile_grad)
-        # ax[0,2].imshow(img_dict[g][0]["y1"])
-        # ax[0,0].text(1450, 0.8, f"Y1 Jaw offset = {round(y1_offset,3)} mm")    #pixel size 0.34 mm /2
-    
-        # ax[1,0].plot(y2_profile)
-        # ax[1,1].plot(y2_profile_grad)
-        # ax[1,2].imshow(img_dict[g][0]["y2"])
-        # ax[1,0].text(0, 0.8, f"Y2 Jaw offset = {round(y2_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # ax[2,0].plot(x1_profile)
-        # ax[2,1].plot(x1_profile_grad)
-        # ax[2,2].imshow(img_dict[g][0]["x1"])
-        # ax[2,0].text(0, 0.8, f"X1 Jaw offset = {round(x1_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # ax[3,0].plot(x2_profile)
-        # ax[3,1].plot(x2_profile_grad)
-        # ax[3,2].imshow(img_dict[g][0]["x2"])
-        # ax[3,0].text(1450, 0.8, f"X2 Jaw offset = {round(x2_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        #fig.savefig(os.path.join(os.getcwd(), f"U{unit_num}_Output", f"{g}_{0}_{datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")}"))
-        #plt.show()
-        #del fig
-
-        #plt.close()
-
-        #y1 - want profile through centre y along x
-        x1_profile = deepcopy(img_dict[g][90]["x1"][:, round(isocentre[1])-20:round(isocentre[1])+20])
-        x1_profile[0:int(x1_profile.shape[0]/4),:] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        x1_profile[int(3*x1_profile.shape[0]/4):,:] = 1
-        x1_offset = (find_half_intensity_pixel(x1_profile) - isocentre[0])* 0.224/2   #make negative to follow sign convention (positive if jaw crosses iso, negative if shy)
-        offset_dict[g][90]["x1"] = x1_offset
-
-        #repeat for y2 jaw
-        x2_profile = deepcopy(img_dict[g][90]["x2"][:, round(isocentre[1])-20:round(isocentre[1])+20])
-        x2_profile[0:int(x2_profile.shape[0]/4),:] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        x2_profile[int(3*x2_profile.shape[0]/4):,:] = 1
-        x2_offset = -(find_half_intensity_pixel(x2_profile) - isocentre[0])* 0.224/2
-        offset_dict[g][90]["x2"] = x2_offset 
-
-        #repeat for x1 jaw
-        y2_profile = deepcopy(img_dict[g][90]["y2"][round(isocentre[0])-20:round(isocentre[0])+20, :])
-        y2_profile[:, 0:int(y2_profile.shape[1]/4)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        y2_profile[:, int(3*y2_profile.shape[1]/4):] = 1
-        y2_offset = -(find_half_intensity_pixel(y2_profile) - isocentre[1])* 0.224/2
-        offset_dict[g][90]["y2"] = y2_offset
-
-        #repeat for x2 jaw
-        y1_profile = deepcopy(img_dict[g][90]["y1"][round(isocentre[0])-20:round(isocentre[0])+20, :])
-        y1_profile[:, 0:int(y1_profile.shape[1]/4)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        y1_profile[:, int(3*y1_profile.shape[1]/4):] = 1
-        y1_offset = (find_half_intensity_pixel(y1_profile) - isocentre[1])* 0.224/2
-        offset_dict[g][90]["y1"] = y1_offset 
-
-
-        # fig, ax = plt.subplots(nrows=4, ncols=3, figsize=(17,17))
-        
-        # ax[0,0].set_title(f"Gantry Angle: {g}$^\circ$, Collimator Angle: {90}$^\circ$")
-        # ax[0,0].plot(y1_profile)
-        # ax[0,1].plot(y1_profile_grad)
-        # ax[0,2].imshow(img_dict[g][90]["y1"])
-        # ax[0,0].text(1450, 0.8, f"Y1 Jaw offset = {round(y1_offset,3)} mm")    #pixel size 0.34 mm /2
-    
-        # ax[1,0].plot(y2_profile)
-        # ax[1,1].plot(y2_profile_grad)
-        # ax[1,2].imshow(img_dict[g][90]["y2"])
-        # ax[1,0].text(0, 0.8, f"Y2 Jaw offset = {round(y2_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # ax[2,0].plot(x1_profile)
-        # ax[2,1].plot(x1_profile_grad)
-        # ax[2,2].imshow(img_dict[g][90]["x1"])
-        # ax[2,0].text(1450, 0.8, f"X1 Jaw offset = {round(x1_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # ax[3,0].plot(x2_profile)
-        # ax[3,1].plot(x2_profile_grad)
-        # ax[3,2].imshow(img_dict[g][90]["x2"])
-        # ax[3,0].text(0, 0.8, f"X2 Jaw offset = {round(x2_offset,3)} mm")    #pixel size 0.34 mm /2
-        
-        # fig.savefig(os.path.join(os.getcwd(), f"U{unit_num}_Output", f"{g}_{90}_{datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")}"))
-        # del fig
-        # plt.close()
-        #plt.show()
-
-
-        # #Now repeat for the c = 270 images from left counter clockwise - (y1, x2, y2, x1)
-        #x2 - want profile through centre y along x
-        # x2_profile = deepcopy(img_dict[g][270]["x2"][:, round(isocentre[1])-20:round(isocentre[1])+20])
-        # x2_profile[0:int(x2_profile.shape[0]/4):] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        # x2_profile[int(3*x2_profile.shape[0]/4):,:] = 1
-        # #determine centre as pixel with sharpest gradient
-        # x2_offset = (np.mean(np.argmin(abs(x2_profile - 0.5), axis=0)) - isocentre[0]) * 0.224/2   #make negative to follow sign convention (positive if jaw crosses iso, negative if shy)     
-        # offset_dict[g][270]["x2"] = x2_offset 
-        # #repeat for x1 jaw
-        # x1_profile = deepcopy(img_dict[g][270]["x1"][:, round(isocentre[1])-20:round(isocentre[1])+20])
-        # x1_profile[0:int(x1_profile.shape[0]/4),:] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        # x1_profile[int(3*x1_profile.shape[0]/4):,:] = 1
-        # x1_offset = -(np.mean(np.argmin(abs(x1_profile - 0.5), axis=0)) - isocentre[0])* 0.224/2
-        # offset_dict[g][270]["x1"] = x1_offset 
-
-        # #repeat for y1 jaw
-        # y1_profile = deepcopy(img_dict[g][270]["y1"][round(isocentre[0])-20:round(isocentre[0])+20, :])
-        # y1_profile[:,0:int(y1_profile.shape[1]/4)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        # y1_profile[:,int(3*y1_profile.shape[1]/4):] = 1
-        # y1_offset = -(np.mean(np.argmin(abs(y1_profile - 0.5), axis=1)) - isocentre[1])* 0.224/2
-        # offset_dict[g][270]["y1"] = y1_offset  
- 
-        # #repeat for y2 jaw
-        # y2_profile = deepcopy(img_dict[g][270]["y2"][round(isocentre[0])-20:round(isocentre[0])+20, :])
-        # y2_profile[:,0:int(y2_profile.shape[1]/4)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-        # y2_profile[:,int(3*y2_profile.shape[1]/4):] = 1
-        # y2_offset = (np.mean(np.argmin(abs(y2_profile - 0.5), axis=1)) - isocentre[1])* 0.224/2
-        # offset_dict[g][270]["y2"] = y2_offset 
-
-        # offset_dict[g][270].pop('x2', None)
-        # offset_dict[g][270].pop('x1', None)
-        # offset_dict[g][270].pop('y1', None)
-        # offset_dict[g][270].pop('y2', None)
-
-        # fig, ax = plt.subplots(nrows=4, ncols=3, figsize=(17, 17))
-        # ax[0,0].set_title(f"Gantry Angle: {g}$^\circ$, Collimator Angle: {270}$^\circ$")
-        # ax[0,0].plot(y1_profile)
-        # ax[0,1].plot(y1_profile_grad)
-        # ax[0,2].imshow(img_dict[g][270]["y1"])
-        # ax[0,0].text(1450, 0.8, f"Y1 Jaw offset = {round(y1_offset,3)} mm")    #pixel size 0.34 mm /2
-    
-        # ax[1,0].plot(y2_profile)
-        # ax[1,1].plot(y2_profile_grad)
-        # ax[1,2].imshow(img_dict[g][270]["y2"])
-        # ax[1,0].text(0, 0.8, f"Y2 Jaw offset = {round(y2_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # ax[2,0].plot(x1_profile)
-        # ax[2,1].plot(x1_profile_grad)
-        # ax[2,2].imshow(img_dict[g][270]["x1"])
-        # ax[2,0].text(0, 0.8, f"X1 Jaw offset = {round(x1_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # ax[3,0].plot(x2_profile)
-        # ax[3,1].plot(x2_profile_grad)
-        # ax[3,2].imshow(img_dict[g][270]["x2"])
-        # ax[3,0].text(1450, 0.8, f"X2 Jaw offset = {round(x2_offset,3)} mm")    #pixel size 0.34 mm /2
-
-        # fig.savefig(os.path.join(os.getcwd(), f"U{unit_num}_Output", f"{g}_{0}_{datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")}"))
-        # #plt.show()
-        # del fig
-        # plt.close()
+        for c in coll_angles:
+            for jaw, direction, sign in junction_profile_specs[c]:
+                if jaw not in img_dict[g].get(c, {}):
+                    print(f"No junction image for gantry {g}, collimator {c}, {jaw}")
+                    continue
+                strip_keys.append((g, c, jaw, isocentre[0] if direction == "vertical" else isocentre[1], sign))
+                strips.append(get_junction_strip(img_dict[g][c][jaw], isocentre, direction))
+
+    #strips of the same shape (all of them, for square images) are copied into one stack, so the images themselves are never copied or changed
+    edges = np.full(len(strips), np.nan)
+    for shape in dict.fromkeys(strip.shape for strip in strips):
+        inds = [i for i, strip in enumerate(strips) if strip.shape == shape]
+        stack = np.empty((len(inds),) + shape, dtype=np.result_type(*[strips[i] for i in inds]))
+        for k, i in enumerate(inds):
+            stack[k] = strips[i]
+        stack[:, 0:int(shape[0]/4), :] = 1    #make borders one so that center closed jaw is properly found, and not the other jaw edge. 
+        stack[:, int(3*shape[0]/4):, :] = 1
+        edges[inds] = find_strip_edges(stack)
+
+    for (g, c, jaw, iso_pixel, sign), edge in zip(strip_keys, edges):
+        if np.isnan(edge):
+            print(f"Could not find the {jaw} jaw edge for gantry {g}, collimator {c}")
+            continue
+        offsets.set(g, c, jaw, sign*(edge - iso_pixel) * 0.224/2)
 
     #now want bar plots of offsets vs/ gantry / collimator for each angle
     #for clustered bar, need to sort data first into a new dictionary for plotting
@@ -667,8 +685,15 @@ def get_junc_offsets(img_dict, unit_num):
 
 
 
-    return offset_dict
+    return offsets
             
+def find_half_edge_index(profile, masked):
+    #finds the index of the pixel closest to 0.5 in a profile, treating the pixels in the masked slice as 1 (so the other jaw's edge isn't found). 
+    #The profile can be a view into an image; only the small scratch array of differences is changed
+    diffs = abs(profile - 0.5)
+    diffs[masked] = 0.5
+    return np.argmin(diffs)
+
 def get_jaw_offsets(img_dict,isocentre):
     #this function will determine the offset of each 1/4 blocked beam jaw with the isocentre (defined by bead in each phantom image at each gantry/coll setting)
     #values will be reported such that negative means the jaw passed over the iso, positive means it doesn't reach it. 
@@ -679,80 +704,80 @@ def get_jaw_offsets(img_dict,isocentre):
     for fs in [2.5, 5.0,7.5, 10.0]:
         #y1 - want profile through centre y along x
         try:
-            y1_profile = deepcopy(img_dict["y1"][fs][:, round(isocentre[1])])
-            y1_profile[0:int(y1_profile.size/2)] = 1  
-            y1_offset = (np.argmin(abs(y1_profile - 0.5)) - isocentre[0]) * 0.224/2   #make negative to follow sign convention (positive if jaw openy)     
+            y1_profile = img_dict["y1"][fs][:, round(isocentre[1])]
+            y1_offset = (find_half_edge_index(y1_profile, slice(0, int(y1_profile.size/2))) - isocentre[0]) * 0.224/2   #make negative to follow sign convention (positive if jaw openy)     
             offset_dict["y1"][fs] = round(y1_offset /10, 2)
         except:
             print(f"Could not find asymmetric jaw image for Y1 and fs: {fs}")
 
         #repeat for y2 jaw
         try:
-            y2_profile = deepcopy(img_dict["y2"][fs][:, round(isocentre[1])])
-            y2_profile[int(y2_profile.size/2):] = 1  
-            y2_offset = -(np.argmin(abs(y2_profile - 0.5)) - isocentre[0])* 0.224/2
+            y2_profile = img_dict["y2"][fs][:, round(isocentre[1])]
+            y2_offset = -(find_half_edge_index(y2_profile, slice(int(y2_profile.size/2), None)) - isocentre[0])* 0.224/2
             offset_dict["y2"][fs] = round(y2_offset/10, 2)
         except:
             print(f"Could not find asymmetric jaw image for Y2 and fs: {fs}")
 
         #repeat for x1 jaw
         try:
-            x1_profile = deepcopy(img_dict["x1"][fs][round(isocentre[0]), :])
-            x1_profile[int(x1_profile.size/2):] = 1  
-            x1_offset = -(np.argmin(abs(x1_profile - 0.5)) - isocentre[1])* 0.224/2
+            x1_profile = img_dict["x1"][fs][round(isocentre[0]), :]
+            x1_offset = -(find_half_edge_index(x1_profile, slice(int(x1_profile.size/2), None)) - isocentre[1])* 0.224/2
             offset_dict["x1"][fs] = round(x1_offset/10, 2)
         except:
             print(f"Could not find asymmetric jaw image for X1 and fs: {fs}")
 
         #repeat for x2 jaw
         try:
-            x2_profile = deepcopy(img_dict["x2"][fs][round(isocentre[0]), :])
-            x2_profile[0:int(x2_profile.size/2)] = 1    #make borders zero so that center closed jaw is properly found, and not the other jaw edge. 
-            x2_offset = (np.argmin(abs(x2_profile - 0.5)) - isocentre[1])* 0.224/2
+            x2_profile = img_dict["x2"][fs][round(isocentre[0]), :]
+            x2_offset = (find_half_edge_index(x2_profile, slice(0, int(x2_profile.size/2))) - isocentre[1])* 0.224/2
             offset_dict["x2"][fs] = round(x2_offset/10, 2)
         except:
             print(f"Could not find asymmetric jaw image for Y2 and fs: {fs}")
 
     return offset_dict
 
-def find_bead_location(image: np.array, round_final=True, zoom_size=2):
+def find_bead_location(image: np.array, round_final=True, zoom_size=2, norm_reference=None, refine_zoom=1):
     #here we simply determine the pixel location of the centre of the bead in the cubic phantom
-    #img = (deepcopy(image) - np.amin(image)) / (np.amax(image) - np.amin(image))
-    img = normalize_by_top_median(deepcopy(image))
-
-    # img[img > 0.78] = 0.8   #for plotting
-    # img[img < 0.68] = 0.65
+    #norm_reference - optionally the image before zooming, to compute the normalization on (see normalize_by_top_median)
+    #refine_zoom - if > 1, the centre is refined to sub-pixel precision on a small patch around it upsampled by this factor (see refine_dark_centroid)
+    #The bead centre of each image is memoized (see DerivedResults), so asking for it again (rounded or not) doesn't search the image again
+    centre_of_mass = derived_results.get(get_bead_centre, image, zoom_size=zoom_size, norm_reference=norm_reference, refine_zoom=refine_zoom)
 
-    # plt.imshow(img, cmap="bone")
-    # plt.show()
-
-
-    #make outside borders large to make isocentre lowest value
-    img[:,0:int(14*img.shape[1]/30)] = 1
-    img[:,int(16*img.shape[1]/30):] = 1
-    img[0:int(14*img.shape[0]/30),:] = 1
-    img[int(16*img.shape[0]/30):,:] = 1
+    if round_final==False:
+        return [round(centre_of_mass[0], 2), round(centre_of_mass[1],2)]
+    else:
+        return [round(centre_of_mass[0]), round(centre_of_mass[1])]
 
+def get_bead_centre(image: np.array, zoom_size=2, norm_reference=None, refine_zoom=1):
+    #unrounded centre of mass (pixels) of the bead, see find_bead_location
+    #The bead is the centroid of the lowest 200*int(zoom_size/2)**2 pixels within the central window (14/30 to 16/30 of the image each way), with the rest
+    #of the image treated as 1 so the isocentre is the lowest value. Only the window is normalized, and the threshold is picked with a partial sort.
+    row_start, row_stop = int(14*image.shape[0]/30), int(16*image.shape[0]/30)
+    col_start, col_stop = int(14*image.shape[1]/30), int(16*image.shape[1]/30)
+    img = np.asarray(image[row_start:row_stop, col_start:col_stop]) / get_norm_median(image, reference=norm_reference)
+    border_pixels = image.shape[0]*image.shape[1] - img.size    #pixels outside the window, which count as 1
 
     #now keep the lowest 100 pixels (will be the bead location, and find centre of mass)
-    pixel_list = sorted(img.flatten().tolist())
-    pixel_100 = pixel_list[200*int(zoom_size/2)**2]
-    img[img > pixel_100] = 0
-
-    #now find the centre of mass of the remaining pixels 
-    centre_pixels = np.nonzero(img)
-
-    centre_of_mass = np.mean(centre_pixels, axis=1)
+    num = 200*int(zoom_size/2)**2
+    pixel_100 = np.partition(img, num, axis=None)[num] if num < img.size else np.inf
+    if pixel_100 > 1:    #the threshold is one of the border pixels, or is past them
+        below = np.count_nonzero(img <= 1)
+        pixel_100 = 1 if below + border_pixels > num else np.partition(img, num - border_pixels, axis=None)[num - border_pixels]
+
+    #now find the centre of mass of the remaining pixels (the border pixels only count if the threshold reaches 1)
+    if pixel_100 >= 1:
+        mask = np.ones(image.shape[:2], dtype=bool)
+        mask[row_start:row_stop, col_start:col_stop] = (img <= pixel_100) & (img != 0)
+        centre_of_mass = np.mean(np.nonzero(mask), axis=1)
+    else:
+        centre_pixels = np.nonzero((img <= pixel_100) & (img != 0))
+        centre_of_mass = np.mean(centre_pixels, axis=1) + [row_start, col_start]
 
-    img[round(centre_of_mass[0]), round(centre_of_mass[1])] = 1
-    # plt.imshow(img)
-    # plt.show()
+    if refine_zoom > 1:
+        centre_of_mass = refine_dark_centroid(img, centre_of_mass - [row_start, col_start], num, refine_zoom=refine_zoom) + [row_start, col_start]
     print(centre_of_mass)
 
-    if round_final==False:
-        return [round(centre_of_mass[0], 2), round(centre_of_mass[1],2)]
-    else:
-        return [round(centre_of_mass[0]), round(centre_of_mass[1])]
+    return centre_of_mass
 
 def calculate_cost(offsets : dict, old_offsets, use_lrfc, lrfc_vals,junction_priority=0.5, optimize_lrfc=True, optimize_junctions=True):
     #this function takes a dictionary of jaw offsets at all gantry/collimator angles and returns the cost function
@@ -881,76 +906,738 @@ def calculate_cost(offsets : dict, old_offsets, use_lrfc, lrfc_vals,junction_pri
 
     return cost
 
+def get_cost_components(offsets : dict, shifts : dict, lrfc_vals=None, optimize_lrfc=True):
+    #this is a vectorized version of the cost terms in calculate_cost. Rather than rebuilding the offset dictionary for every calibration point,
+    #each term is evaluated for a whole array of calibration points at once using numpy broadcasting.
+    #
+    #Variables:
+    #offsets (dict) - the original (unshifted) offsets for each gantry angle, collimator angle, jaw
+    #shifts (dict) - jaw --> array of calibration point offsets from isocentre (mm). The arrays only need to broadcast against each other, so
+    #   passing x1_iters[:,None,None,None], x2_iters[None,:,None,None], ... evaluates the full 4d grid, while equal length 1d arrays evaluate a list of points.
+    #   Jaws left out of shifts are left out of the returned terms.
+    #   If the offset table has sample axes (see OffsetTable), they are put in front of the shift axes in the returned terms.
+    #lrfc_vals - list of [rad_disp, jaw_disps] for each lrfc image (None if lrfc not used)
+    #
+    #returns a dictionary with the unweighted cost terms "absolute", "junction", "cold_junction" and "lrfc" (see combine_cost_components for weighting)
+
+    offsets = as_offset_table(offsets)
+    components = {}
+
+    #new offsets are the difference in offset from the g0c0 calibration position + the cal position offset from isocentre (same as OffsetTable.shifted)
+    relative = offsets.relative()
+    shift_ndim = max(np.ndim(shift) for shift in shifts.values())
+    def expand(offset):
+        #puts the sample axes (if any) of an offset in front of the shift axes
+        return np.reshape(offset, np.shape(offset) + (1,)*shift_ndim)
+
+    cost_absolute = 0
+    for jaw, shift in shifts.items():
+        jaw_relative = relative[..., offsets.jaws.index(jaw)]
+        measured = ~np.isnan(jaw_relative.reshape((-1,) + jaw_relative.shape[-2:])[0])
+        for g_ind, c_ind in np.argwhere(measured):
+            cost_absolute = cost_absolute + np.abs(expand(jaw_relative[..., g_ind, c_ind]) + shift)
+    components["absolute"] = cost_absolute / (4*2*6)
+
+    #junction terms only depend on the x1 and x2 shifts
+    if "x1" in shifts and "x2" in shifts:
+        g0c90_x1 = expand(relative[(Ellipsis,) + offsets.index(0, 90, "x1")]) + shifts["x1"]
+        g180c90_x1 = expand(relative[(Ellipsis,) + offsets.index(180, 90, "x1")]) + shifts["x1"]
 
-def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrfc_folder=None, optimize_junctions=True):
+        cost_junction = 0
+        cost_cold_junction = 0
+        for g in [50, 130, 310, 230]:
+            lower_x2 = expand(relative[(Ellipsis,) + offsets.index(g, 90, "x2")]) + shifts["x2"]
+            for junction_gap in [lower_x2 + g0c90_x1, lower_x2 + g180c90_x1]:
+                cost_junction = cost_junction + np.where(np.abs(junction_gap) > 0.9, 2*np.abs(junction_gap), np.abs(junction_gap))
+                cost_cold_junction = cost_cold_junction + np.where(junction_gap < 0, np.abs(junction_gap), 0)
+        components["junction"] = cost_junction / 8
+        components["cold_junction"] = cost_cold_junction / 8
+
+    if lrfc_vals and optimize_lrfc:
+        #jaw displacements from the original configuration at g0c0
+        disps = {jaw: shift - expand(offsets.get(0, 0, jaw)) for jaw, shift in shifts.items()}
+        lrfc_cost = 0
+        for lrfc_val in lrfc_vals:
+            rad_disp = lrfc_val[0]
+            new_rad_disps = []
+            if "y1" in disps and "y2" in disps:
+                new_rad_disps.append(rad_disp[0] + (disps["y1"]/2 + -disps["y2"]/2))
+            if "x1" in disps and "x2" in disps:
+                new_rad_disps.append(rad_disp[1] + (-disps["x1"]/2 + disps["x2"]/2))
+            for new_rad_disp in new_rad_disps:
+                lrfc_cost = lrfc_cost + np.where(new_rad_disp < 0.4, 0, np.where(new_rad_disp < 0.7, np.abs(new_rad_disp*3), np.abs(new_rad_disp*10)))
+
+            #new g0c0 jaw displacements are just the shifts themselves
+            for jaw in ["y1", "y2", "x1", "x2"]:
+                if jaw not in shifts:
+                    continue
+                lrfc_jaw_disp = shifts[jaw]
+                lrfc_cost = lrfc_cost + np.where(np.abs(lrfc_jaw_disp) < 0.5, lrfc_jaw_disp/4, np.where(np.abs(lrfc_jaw_disp) < 0.75, 3*lrfc_jaw_disp/4, 10*lrfc_jaw_disp/4))
+        components["lrfc"] = lrfc_cost / (2*len(lrfc_vals))
+
+    return components
+
+def combine_cost_components(components : dict, junction_priority, optimize_junctions=True):
+    #weights the cost terms from get_cost_components into the total cost, in the same way as calculate_cost
+    if optimize_junctions == True:
+        cost = (1-junction_priority)*components["absolute"]
+        if "junction" in components:
+            cost = junction_priority*(components["junction"]+components["cold_junction"]) + cost
+    else:
+        cost = components["absolute"]
+
+    if "lrfc" in components:
+        cost = cost + components["lrfc"]
+
+    return cost
+
+def get_cost_component_grid(offsets : dict, iters, lrfc_vals=None, optimize_lrfc=True):
+    #evaluates each (unweighted) cost term over the grid iters = [x1_iters, x2_iters, y1_iters, y2_iters], kept separate so the terms can be 
+    #re-weighted for any junction_priority with reweight_cost_grid without recalculating them.
+    #Terms keep their broadcast shape, e.g. the junction terms only depend on x1 and x2 so have shape (x1, x2, 1, 1)
+    x1_iters, x2_iters, y1_iters, y2_iters = [np.asarray(iters_, dtype=float) for iters_ in iters]
+    shifts = {"x1": x1_iters[:,None,None,None], "x2": x2_iters[None,:,None,None], "y1": y1_iters[None,None,:,None], "y2": y2_iters[None,None,None,:]}
+    return get_cost_components(offsets, shifts, lrfc_vals=lrfc_vals, optimize_lrfc=optimize_lrfc)
+
+def reweight_cost_grid(components : dict, iters, junction_priority, optimize_junctions=True):
+    #combines the cost terms from get_cost_component_grid with a (new) junction_priority and finds the optimum, which only takes a few ms
+    #so the trade off between junctions and absolute offsets can be explored interactively.
+    #returns the optimal [x1, x2, y1, y2] grid point and the full cost grid (shape (x1, x2, y1, y2)), with ties going to the first grid point as in get_opt_origin
+    grid_shape = tuple(len(iters_) for iters_ in iters)
+    cost_vals = np.array(np.broadcast_to(combine_cost_components(components, junction_priority, optimize_junctions=optimize_junctions), grid_shape), dtype=float)
+    opt_offset_ind = np.unravel_index(np.argmin(cost_vals), grid_shape)
+    opt_offset = [iters[i][opt_offset_ind[i]] for i in range(4)]
+    return opt_offset, cost_vals
+
+def sweep_junction_priority(components : dict, iters, junction_priorities, optimize_junctions=True, chunk_size=65536):
+    #finds the optimum for every junction priority in junction_priorities from the cost terms of get_cost_component_grid, in one pass over the grid
+    #(each chunk of grid points is weighted for all priorities while it is in cache). Also finds the pareto front of the junction cost (junction + cold junction)
+    #against the absolute cost: the grid points where neither can be lowered without raising the other.
+    #
+    #returns (sweep, front), lists of dictionaries with the shift ("x1", "x2", "y1", "y2") and cost terms ("junction", "absolute", "lrfc") of each point;
+    #sweep rows also have the "junction_priority" and weighted "cost"
+    grid_shape = tuple(len(iters_) for iters_ in iters)
+    num_points = int(np.prod(grid_shape))
+    flat = {name: np.broadcast_to(term, grid_shape).reshape(-1) for name, term in components.items()}
+    junction_cost = flat["junction"] + flat["cold_junction"] if "junction" in flat else np.zeros(num_points)
+
+    best_cost = np.full(len(junction_priorities), np.inf)
+    best_ind = np.zeros(len(junction_priorities), dtype=int)
+    for start in range(0, num_points, chunk_size):
+        chunk = {name: term[start:start+chunk_size] for name, term in flat.items()}
+        for p, junction_priority in enumerate(junction_priorities):
+            cost = combine_cost_components(chunk, junction_priority, optimize_junctions=optimize_junctions)
+            ind = np.argmin(cost)
+            if cost[ind] < best_cost[p]:    #strictly lower, so ties go to the first grid point as in reweight_cost_grid
+                best_cost[p] = cost[ind]
+                best_ind[p] = start + ind
+
+    def point_row(ind):
+        grid_ind = np.unravel_index(ind, grid_shape)
+        row = {jaw: iters[j][grid_ind[j]] for j, jaw in enumerate(["x1", "x2", "y1", "y2"])}
+        row.update({"junction": junction_cost[ind], "absolute": flat["absolute"][ind], "lrfc": flat["lrfc"][ind] if "lrfc" in flat else 0})
+        return row
+
+    sweep = []
+    for p, junction_priority in enumerate(junction_priorities):
+        row = {"junction_priority": junction_priority}
+        row.update(point_row(best_ind[p]))
+        row["cost"] = best_cost[p]
+        sweep.append(row)
+
+    #pareto front: going through points in order of junction cost, keep each one that has a lower absolute cost than all before it
+    order = np.lexsort((flat["absolute"], junction_cost))
+    running_min = np.minimum.accumulate(flat["absolute"][order])
+    on_front = np.concatenate([[True], flat["absolute"][order][1:] < running_min[:-1]])
+    front = [point_row(ind) for ind in order[on_front]]
+
+    return sweep, front
+
+def write_priority_sweep_csv(sweep, front, unit_num):
+    #writes the junction priority sweep and pareto front (from sweep_junction_priority) to a csv in the unit's output folder
+    with open(os.path.join(os.getcwd(), f"U{unit_num}_Output", f"junction_priority_sweep_{datetime.datetime.now().strftime('%Y-%m-%d_%H_%M_%S')}.csv"), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Junction Priority Sweep"])
+        writer.writerow(["Junction Priority", "X1", "X2", "Y1", "Y2", "Junction Cost", "Absolute Cost", "LRFC Cost", "Total Cost"])
+        for row in sweep:
+            writer.writerow([row["junction_priority"], row["x1"], row["x2"], row["y1"], row["y2"], row["junction"], row["absolute"], row["lrfc"], row["cost"]])
+        writer.writerow(["","",""])
+        writer.writerow(["Pareto Front (Junction vs Absolute Cost)"])
+        writer.writerow(["Junction Cost", "Absolute Cost", "X1", "X2", "Y1", "Y2", "LRFC Cost"])
+        for row in front:
+            writer.writerow([row["junction"], row["absolute"], row["x1"], row["x2"], row["y1"], row["y2"], row["lrfc"]])
+
+def get_cost_grid(offsets : dict, iters, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True):
+    #evaluates the cost function at every calibration point of the grid in a few array operations.
+    #iters is [x1_iters, x2_iters, y1_iters, y2_iters] and the returned cost_vals has shape (x1, x2, y1, y2), 
+    #giving the same values as calling calculate_cost on the shifted offsets at each grid point.
+    components = get_cost_component_grid(offsets, iters, lrfc_vals=lrfc_vals, optimize_lrfc=optimize_lrfc)
+    cost = combine_cost_components(components, junction_priority, optimize_junctions=optimize_junctions)
+
+    return np.array(np.broadcast_to(cost, tuple(len(iters_) for iters_ in iters)), dtype=float)
+
+class CandidateTracker:
+    #keeps the top_k lowest cost grid points (a heap, updated chunk by chunk as the grid is evaluated) and the extent of the near optimal plateau: 
+    #the range of each jaw's shift over the grid points within plateau_tol of the minimum cost. The cost is piecewise linear, so there are often large 
+    #plateaus of almost equal cost, and these give the alternatives to the single optimum.
+    #
+    #The plateau is tracked with the lowest cost seen at each x1, x2, y1 and y2 grid value, so nothing the size of the grid is kept.
+    #Ties go to the first grid point, as in the grid search.
+    def __init__(self, iters, top_k=10, plateau_tol=0.01):
+        self.iters = [np.asarray(iters_, dtype=float) for iters_ in iters]
+        self.grid_shape = tuple(iters_.size for iters_ in self.iters)
+        self.top_k = top_k
+        self.plateau_tol = plateau_tol
+        self._heap = []    #(-cost, -flat index), so the worst kept candidate is on top
+        self._axis_min = [np.full(size, np.inf) for size in self.grid_shape]
+
+    def update(self, cost, start=(0, 0, 0, 0)):
+        #adds a block of the cost grid, cost[a, b, c, d] being the cost at grid index (start[0] + a, start[1] + b, ...)
+        cost = np.asarray(cost, dtype=float)
+        flat_cost = cost.reshape(-1)
+        for axis in range(4):
+            other_axes = tuple(other for other in range(4) if other != axis)
+            axis_min = self._axis_min[axis][start[axis]:start[axis] + cost.shape[axis]]
+            np.minimum(axis_min, np.amin(cost, axis=other_axes), out=axis_min)
+
+        #only the block's lowest points (and its first minimum) can make it into the top_k
+        block_inds = np.argpartition(flat_cost, self.top_k - 1)[:self.top_k] if flat_cost.size > self.top_k else np.arange(flat_cost.size)
+        block_inds = np.union1d(block_inds, [np.argmin(flat_cost)])
+        grid_inds = np.ravel_multi_index(tuple(np.add(np.unravel_index(block_inds, cost.shape), np.reshape(start, (4, 1)))), self.grid_shape)
+        for block_ind, grid_ind in zip(block_inds, grid_inds):
+            candidate = (-flat_cost[block_ind], -int(grid_ind))
+            if len(self._heap) < self.top_k:
+                heapq.heappush(self._heap, candidate)
+            elif candidate > self._heap[0]:
+                heapq.heapreplace(self._heap, candidate)
+
+    def candidates(self):
+        #[(cost, (x1_ind, x2_ind, y1_ind, y2_ind)), ...] lowest cost first
+        top = sorted((-neg_cost, -neg_ind) for neg_cost, neg_ind in self._heap)
+        return [(float(cost), tuple(int(ind) for ind in np.unravel_index(flat_ind, self.grid_shape))) for cost, flat_ind in top]
+
+    def plateau(self):
+        #{jaw: [lowest shift, highest shift]} over the grid points within plateau_tol of the minimum cost
+        min_cost = -max(self._heap)[0]
+        plateau = {}
+        for axis, jaw in enumerate(["x1", "x2", "y1", "y2"]):
+            near_inds = np.flatnonzero(self._axis_min[axis] <= min_cost + self.plateau_tol)
+            plateau[jaw] = [self.iters[axis][near_inds[0]], self.iters[axis][near_inds[-1]]]
+        return plateau
+
+def get_cost_grid_memmap(offsets : dict, iters, grid_file, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True, top_k=10, max_chunk_points=2**22, plateau_tol=0.01):
+    #same cost grid as get_cost_grid, but evaluated in chunks (at most max_chunk_points grid points) that are written to grid_file, a float32 .npy file 
+    #which is memory mapped, so memory use stays the same however fine the grid is (e.g. 0.01 mm steps give ~10^8 points). The minimum and the top_k 
+    #lowest cost points are tracked as the chunks are evaluated, so the file never has to be read back in full; slices can be read from it with 
+    #np.load(grid_file, mmap_mode="r").
+    #
+    #returns {"grid_file", "opt_offset": [x1, x2, y1, y2], "opt_cost", "top_k": [(cost, (x1_ind, x2_ind, y1_ind, y2_ind)), ...] lowest cost first,
+    #"plateau": {jaw: [lowest, highest shift]} within plateau_tol of the minimum} (see CandidateTracker).
+    #Costs are tracked in float64 (only the file is float32) and ties go to the first grid point, as in the in memory grid search
+    offsets = as_offset_table(offsets)
+    x1_iters, x2_iters, y1_iters, y2_iters = [np.asarray(iters_, dtype=float) for iters_ in iters]
+    grid_shape = (x1_iters.size, x2_iters.size, y1_iters.size, y2_iters.size)
+    cost_kwargs = {"lrfc_vals": lrfc_vals, "junction_priority": junction_priority, "optimize_junctions": optimize_junctions, "optimize_lrfc": optimize_lrfc}
+    cost_file = np.lib.format.open_memmap(grid_file, mode="w+", dtype=np.float32, shape=grid_shape)
+
+    #each chunk is one x1 value and a run of x2 values (with every y1, y2), which is a contiguous block of the file
+    x2_step = max(1, max_chunk_points // (y1_iters.size * y2_iters.size))
+    tracker = CandidateTracker(iters, top_k=top_k, plateau_tol=plateau_tol)
+    for i in range(x1_iters.size):
+        for j in range(0, x2_iters.size, x2_step):
+            cost = get_cost_grid(offsets, [x1_iters[i:i+1], x2_iters[j:j+x2_step], y1_iters, y2_iters], **cost_kwargs)
+            cost_file[i:i+1, j:j+x2_step] = cost
+            tracker.update(cost, start=(i, j, 0, 0))
+    cost_file.flush()
+    del cost_file
+
+    top = tracker.candidates()
+    opt_offset = [iters[k][top[0][1][k]] for k in range(4)]
+    return {"grid_file": grid_file, "opt_offset": opt_offset, "opt_cost": top[0][0], "top_k": top, "plateau": tracker.plateau()}
+
+def _init_cost_worker(offsets, iters, cost_kwargs, return_components=False):
+    #runs once in each worker process of get_cost_grid_parallel, so the offsets and lrfc values are only sent to each worker once
+    global _cost_worker_args
+    _cost_worker_args = (offsets, iters, cost_kwargs, return_components)
+
+def _get_cost_slab(x1_iters):
+    #evaluates the cost grid (or its terms) for one slab of x1 values in a worker process
+    offsets, iters, cost_kwargs, return_components = _cost_worker_args
+    return get_cost_slabs(offsets, [x1_iters] + iters, cost_kwargs, return_components)
+
+def get_cost_slabs(offsets, iters, cost_kwargs, return_components=False):
+    #serial version of get_cost_grid_parallel (also used for the x1 slabs in each worker)
+    if return_components:
+        return get_cost_component_grid(offsets, iters, lrfc_vals=cost_kwargs["lrfc_vals"], optimize_lrfc=cost_kwargs["optimize_lrfc"])
+    return get_cost_grid(offsets, iters, **cost_kwargs)
+
+def iter_cost_slabs(offsets : dict, iters, workers=None, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True, return_components=False, max_slab_points=2**18):
+    #evaluates the cost grid (or its terms, see get_cost_component_grid) in slabs along the x1 axis and yields (first x1 index, slab) in x1 order as the slabs
+    #are finished, so each slab can be used (e.g. scanned for the optimum) while it is still in cache and while the workers evaluate the next ones.
+    #workers is the number of processes (None uses all cores, 1 runs serially). In parallel the grid is split into one slab per worker, serially into slabs 
+    #of at most max_slab_points grid points. Each grid point is evaluated the same way regardless of how the grid is split.
+    offsets = as_offset_table(offsets)
+    cost_kwargs = {"lrfc_vals": lrfc_vals, "junction_priority": junction_priority, "optimize_junctions": optimize_junctions, "optimize_lrfc": optimize_lrfc}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    x1_iters = np.asarray(iters[0], dtype=float)
+    x1_points = int(np.prod([len(iters_) for iters_ in iters[1:]]))
+
+    def serial_slabs():
+        num_slabs = min(x1_iters.size, max(1, -(-x1_iters.size*x1_points // max_slab_points)))
+        start = 0
+        for slab in np.array_split(x1_iters, num_slabs):
+            yield start, get_cost_slabs(offsets, [slab] + list(iters[1:]), cost_kwargs, return_components)
+            start += slab.size
+
+    if workers <= 1 or x1_iters.size <= 1:
+        yield from serial_slabs()
+        return
+
+    slabs = np.array_split(x1_iters, min(workers, x1_iters.size))
+    starts = np.cumsum([0] + [slab.size for slab in slabs[:-1]])
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_cost_worker, initargs=(offsets, list(iters[1:]), cost_kwargs, return_components))
+    except OSError as e:
+        print(f"Could not start worker processes ({e}), evaluating cost grid serially")
+        yield from serial_slabs()
+        return
+    with executor:
+        for start, cost_slab in zip(starts, executor.map(_get_cost_slab, slabs)):
+            yield int(start), cost_slab
+
+def get_cost_grid_parallel(offsets : dict, iters, workers=None, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True, return_components=False):
+    #same as get_cost_grid, but the grid is split into slabs along the x1 axis which are evaluated in a pool of worker processes (see iter_cost_slabs).
+    #workers is the number of processes (None uses all cores, 1 runs serially). Slabs are merged back in x1 order, so the result is identical to the serial cost grid.
+    #return_components - return the separate cost terms (as get_cost_component_grid) rather than the weighted cost
+    cost_slabs = [cost_slab for _, cost_slab in iter_cost_slabs(offsets, iters, workers=workers, lrfc_vals=lrfc_vals, junction_priority=junction_priority, 
+                                                                optimize_junctions=optimize_junctions, optimize_lrfc=optimize_lrfc, return_components=return_components)]
+    if return_components:
+        #every term depends on x1, so the slabs of each term join along the x1 axis
+        return {name: np.concatenate([slab[name] for slab in cost_slabs], axis=0) for name in cost_slabs[0]}
+    return np.concatenate(cost_slabs, axis=0)
+
+def get_separable_optimum(offsets : dict, iters, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True):
+    #The cost function splits into an x block (x1, x2: absolute, junction, cold junction and lrfc x terms) and a y block (y1, y2: absolute and lrfc y terms).
+    #Rather than the full 4d grid, the x1/x2 grid and the y1/y2 grid are searched separately (31^2 + 21^2 points rather than 31^2 * 21^2)
+    #and the two block optima are combined.
+    #
+    #returns the optimal grid indices [x1_ind, x2_ind, y1_ind, y2_ind], or None if the cost is found to have terms coupling the x and y jaws, 
+    #in which case the caller needs to fall back to the joint search.
+    offsets = as_offset_table(offsets)
+    x1_iters, x2_iters, y1_iters, y2_iters = [np.asarray(iters_, dtype=float) for iters_ in iters]
+
+    def block_cost(shifts):
+        components = get_cost_components(offsets, shifts, lrfc_vals=lrfc_vals, optimize_lrfc=optimize_lrfc)
+        return combine_cost_components(components, junction_priority, optimize_junctions=optimize_junctions)
+
+    cost_x = np.array(np.broadcast_to(block_cost({"x1": x1_iters[:,None], "x2": x2_iters[None,:]}), (x1_iters.size, x2_iters.size)))
+    cost_y = np.array(np.broadcast_to(block_cost({"y1": y1_iters[:,None], "y2": y2_iters[None,:]}), (y1_iters.size, y2_iters.size)))
+
+    x1_ind, x2_ind = np.argwhere(cost_x == np.amin(cost_x))[0]
+    y1_ind, y2_ind = np.argwhere(cost_y == np.amin(cost_y))[0]
+
+    #cross term correction: the joint cost minus the two block costs is zero for a separable cost. Check this at the combined optimum and at a few
+    #other points on the grid, and give up on the block search if any cross term is found
+    check_inds = np.array([[x1_ind, x2_ind, y1_ind, y2_ind], [0, 0, 0, 0], [-1, -1, -1, -1], [0, -1, -1, 0], [-1, 0, 0, -1], [x1_ind, x2_ind, 0, -1], [0, -1, y1_ind, y2_ind]])
+    check_shifts = {"x1": x1_iters[check_inds[:,0]], "x2": x2_iters[check_inds[:,1]], "y1": y1_iters[check_inds[:,2]], "y2": y2_iters[check_inds[:,3]]}
+    cross_terms = block_cost(check_shifts) - cost_x[check_inds[:,0], check_inds[:,1]] - cost_y[check_inds[:,2], check_inds[:,3]]
+    if np.amax(np.abs(cross_terms)) > 1e-9:
+        print(f"Cost function is not separable into x and y jaws (largest cross term: {np.amax(np.abs(cross_terms))})")
+        return None
+
+    return np.array([x1_ind, x2_ind, y1_ind, y2_ind])
+
+
+def get_monte_carlo_shifts(offsets : dict, iters, num_samples=1000, sigma=0.1, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True, seed=None, batch_size=500):
+    #estimates the uncertainty in the optimal calibration shift due to noise in the measured offsets (epid edge detection and bead localization).
+    #The offset table is perturbed num_samples times (gaussian noise with standard deviation sigma (mm) on every measured offset) and the optimum of each 
+    #perturbed table is found on the grid iters = [x1_iters, x2_iters, y1_iters, y2_iters]. Each batch of samples is solved in one pass: the perturbed tables are 
+    #stacked along a sample axis, and as the cost splits into an x block and a y block (see get_separable_optimum) only the x1/x2 and y1/y2 grids are needed.
+    #
+    #returns an array (num_samples, 4) of the optimal (x1, x2, y1, y2) shift for each sample, or None if the cost can't be split into x and y blocks
+    offsets = as_offset_table(offsets)
+    cost_kwargs = {"lrfc_vals": lrfc_vals, "junction_priority": junction_priority, "optimize_junctions": optimize_junctions, "optimize_lrfc": optimize_lrfc}
+    if get_separable_optimum(offsets, iters, **cost_kwargs) is None:
+        print("Monte Carlo shifts need the cost to be separable into x and y jaws")
+        return None
+    x1_iters, x2_iters, y1_iters, y2_iters = [np.asarray(iters_, dtype=float) for iters_ in iters]
+
+    def block_optimum(table, iters_a, iters_b, jaw_a, jaw_b):
+        #optimal grid values of one block (e.g. x1/x2) for every sample in the table
+        components = get_cost_components(table, {jaw_a: iters_a[:,None], jaw_b: iters_b[None,:]}, lrfc_vals=lrfc_vals, optimize_lrfc=optimize_lrfc)
+        cost = combine_cost_components(components, junction_priority, optimize_junctions=optimize_junctions)
+        cost = np.broadcast_to(cost, table.values.shape[:-3] + (iters_a.size, iters_b.size)).reshape(-1, iters_a.size * iters_b.size)
+        opt_inds = np.argmin(cost, axis=1)
+        return iters_a[opt_inds // iters_b.size], iters_b[opt_inds % iters_b.size]
+
+    rng = np.random.default_rng(seed)
+    opt_shifts = np.zeros((num_samples, 4))
+    for start in range(0, num_samples, batch_size):
+        num = min(batch_size, num_samples - start)
+        values = offsets.values + rng.normal(0, sigma, (num,) + offsets.values.shape)    #unmeasured (nan) offsets stay nan
+        table = OffsetTable(offsets.gantry_angles, offsets.coll_angles, values=values, iso=offsets.iso)
+        opt_shifts[start:start+num, 0], opt_shifts[start:start+num, 1] = block_optimum(table, x1_iters, x2_iters, "x1", "x2")
+        opt_shifts[start:start+num, 2], opt_shifts[start:start+num, 3] = block_optimum(table, y1_iters, y2_iters, "y1", "y2")
+
+    return opt_shifts
+
+def write_monte_carlo_csv(opt_shifts, sigma, unit_num):
+    #summarizes the spread of the optimal shifts from get_monte_carlo_shifts (printed and written to a csv in the unit's output folder, with every sample)
+    with open(os.path.join(os.getcwd(), f"U{unit_num}_Output", f"monte_carlo_shifts_{datetime.datetime.now().strftime('%Y-%m-%d_%H_%M_%S')}.csv"), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow([f"Optimal Shift Spread ({opt_shifts.shape[0]} samples, offset noise {sigma} mm)"])
+        writer.writerow(["", "Mean", "Standard Deviation", "2.5th Percentile", "97.5th Percentile"])
+        for j, jaw in enumerate(["x1", "x2", "y1", "y2"]):
+            mean = np.mean(opt_shifts[:,j])
+            std = np.std(opt_shifts[:,j])
+            low, high = np.percentile(opt_shifts[:,j], [2.5, 97.5])
+            print(f"{jaw} optimal shift: {round(mean, 3)} +/- {round(std, 3)} mm (95% between {round(low, 3)} and {round(high, 3)} mm)")
+            writer.writerow([jaw.upper(), mean, std, low, high])
+        writer.writerow(["","",""])
+        writer.writerow(["Sample", "X1", "X2", "Y1", "Y2"])
+        for i, shift in enumerate(opt_shifts):
+            writer.writerow([i] + list(shift))
+
+def refine_grid_optimum(cost_func, bounds, num_points, tol=0.005, num_candidates=4):
+    #coarse to fine search of cost_func(iters) (the cost over the grid iters = [one array of shifts per jaw]) within bounds ([[min, max], ...] in mm, one per jaw).
+    #A grid of num_points per jaw is evaluated across bounds, then boxes around the best num_candidates points are repeatedly re-gridded at twice the 
+    #resolution until the grid spacing is below tol (mm).
+    #
+    #The cost function has steps in it (2x junction penalty above 0.9 mm, lrfc thresholds), and the x1 + x2 junction terms make narrow diagonal valleys, 
+    #so the refinement can miss the minimum a coarse grid point sits next to. Several candidates are kept at each level (chosen at least two grid spacings 
+    #apart so they don't all come from the same plateau) and each box spans the neighbouring grid points on both sides of its candidate. The refined result 
+    #is only used if it is at least as good as the coarse grid minimum.
+    #
+    #returns the optimal shift (one per jaw), its cost and the number of points evaluated
+    bounds = np.asarray(bounds, dtype=float)
+    grid_points = np.broadcast_to(num_points, (len(bounds),))
+    spacing = (bounds[:,1] - bounds[:,0]) / (grid_points - 1)
+    boxes = [bounds]
+    num_evaluated = 0
+    best_point = None
+    best_cost = np.inf
+    coarse_point = None
+    while True:
+        points = []
+        costs = []
+        for box in boxes:
+            iters = [np.linspace(box[i,0], box[i,1], grid_points[i]) for i in range(len(box))]
+            cost_vals = np.broadcast_to(cost_func(iters), tuple(grid_points))
+            points.append(np.stack(np.meshgrid(*iters, indexing="ij"), axis=-1).reshape(-1, len(box)))
+            costs.append(cost_vals.ravel())
+        points = np.concatenate(points)
+        costs = np.concatenate(costs)
+        num_evaluated += costs.size
+        order = np.argsort(costs, kind="stable")
+
+        if coarse_point is None:
+            coarse_point, coarse_cost = points[order[0]], costs[order[0]]
+        elif costs[order[0]] < best_cost:    #best refined point
+            best_point = points[order[0]]
+            best_cost = costs[order[0]]
+
+        if np.all(spacing <= tol):
+            break
+
+        candidates = []
+        for i in order:
+            if all(np.any(np.abs(points[i] - candidate) >= 2*spacing - 1e-12) for candidate in candidates):
+                candidates.append(points[i])
+            if len(candidates) == num_candidates:
+                break
+
+        #boxes of +/- one grid spacing around each candidate, gridded with 5 points per jaw (halves the spacing)
+        boxes = [np.clip(np.stack([candidate - spacing, candidate + spacing], axis=1), bounds[:,:1], bounds[:,1:]) for candidate in candidates]
+        grid_points = np.full(len(bounds), 5)
+        spacing = spacing / 2
+
+    if best_cost > coarse_cost:    #fall back to the coarse grid minimum if the refinement did worse (or there was no refinement)
+        return coarse_point, coarse_cost, num_evaluated
+    return best_point, best_cost, num_evaluated
+
+def get_adaptive_optimum(offsets : dict, bounds, tol=0.005, num_candidates=4, num_points=(31, 31, 21, 21), lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True):
+    #this function does a coarse to fine search (see refine_grid_optimum) for the optimal calibration point within bounds ([[x1_min, x1_max], [x2_min, x2_max], ...] in mm).
+    #As in get_separable_optimum, the x1/x2 and y1/y2 blocks are searched separately, each seeded from its block grid (num_points per jaw, by default 
+    #the full grid search's resolution: 31^2 + 21^2 points). The seeds are the x and y halves of the full grid's optimum, so the result is never worse 
+    #than the full grid search, and each refinement level costs num_candidates * 5^2 points per block. 
+    #If the cost is found to have terms coupling the x and y jaws, the search is done over the joint 4d grid instead (num_points per jaw, 
+    #as expensive as the full grid search).
+    #
+    #returns the optimal [x1, x2, y1, y2] shift and its cost
+    offsets = as_offset_table(offsets)
+    bounds = np.asarray(bounds, dtype=float)
+    num_points = np.broadcast_to(num_points, (4,))
+    cost_kwargs = {"lrfc_vals": lrfc_vals, "junction_priority": junction_priority, "optimize_junctions": optimize_junctions, "optimize_lrfc": optimize_lrfc}
+
+    def block_cost(shifts):
+        components = get_cost_components(offsets, shifts, lrfc_vals=lrfc_vals, optimize_lrfc=optimize_lrfc)
+        return combine_cost_components(components, junction_priority, optimize_junctions=optimize_junctions)
+
+    opt_offset = []
+    opt_cost = 0
+    for jaws, block in [(["x1", "x2"], slice(0, 2)), (["y1", "y2"], slice(2, 4))]:
+        block_point, block_opt_cost, _ = refine_grid_optimum(lambda iters: block_cost({jaws[0]: iters[0][:,None], jaws[1]: iters[1][None,:]}), bounds[block], 
+                                                             num_points[block], tol=tol, num_candidates=num_candidates)
+        opt_offset += list(block_point)
+        opt_cost += block_opt_cost
+
+    #the block optima only combine if there are no cross terms between x and y jaws. Check at the optimum and the corners of the bounds
+    check_points = np.array([opt_offset] + [[bounds[0,i], bounds[1,j], bounds[2,k], bounds[3,l]] for i, j, k, l in [(0,0,0,0), (1,1,1,1), (0,1,1,0), (1,0,0,1)]])
+    joint_cost = block_cost({jaw: check_points[:,i] for i, jaw in enumerate(["x1", "x2", "y1", "y2"])})
+    block_costs = block_cost({"x1": check_points[:,0], "x2": check_points[:,1]}) + block_cost({"y1": check_points[:,2], "y2": check_points[:,3]})
+    if np.amax(np.abs(joint_cost - block_costs)) > 1e-9:
+        print(f"Cost function is not separable into x and y jaws (largest cross term: {np.amax(np.abs(joint_cost - block_costs))}), refining the joint grid")
+        opt_offset, opt_cost, _ = refine_grid_optimum(lambda iters: get_cost_grid(offsets, iters, **cost_kwargs), bounds, num_points, tol=tol, num_candidates=num_candidates)
+        return opt_offset, opt_cost
+
+    return np.array(opt_offset), opt_cost
+
+def get_exact_optimum(offsets : dict, bounds, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, optimize_lrfc=True):
+    #Every term of the cost function is piecewise linear in the calibration shifts. The kinks and steps lie along lines in the x1/x2 plane 
+    #(x1 = const and x2 = const for absolute offsets and lrfc jaw thresholds, x1 + x2 = const for junction gaps, x2 - x1 = const for the lrfc x displacement)
+    #and in the y1/y2 plane (y1 = const, y2 = const, y1 - y2 = const for the lrfc y displacement).
+    #Between these lines the cost is linear, so the minimum of each region is at one of its corners. This function finds the global (continuous) optimum
+    #by evaluating the cost just inside every region around every line intersection within bounds ([[x1_min, x1_max], [x2_min, x2_max], ...] in mm).
+    #
+    #returns the optimal [x1, x2, y1, y2] shift and its cost, or None, None if the cost is found to have terms coupling the x and y jaws
+    offsets = as_offset_table(offsets)
+    bounds = np.asarray(bounds, dtype=float)
+
+    def block_cost(shifts):
+        components = get_cost_components(offsets, shifts, lrfc_vals=lrfc_vals, optimize_lrfc=optimize_lrfc)
+        return combine_cost_components(components, junction_priority, optimize_junctions=optimize_junctions)
+
+    #breakpoint lines, stored as (a, b, c) for a*u + b*v = c in the (x1, x2) or (y1, y2) plane
+    relative = offsets.relative()
+    x_lines = []
+    y_lines = []
+    for jaw, lines, a, b in [("x1", x_lines, 1, 0), ("x2", x_lines, 0, 1), ("y1", y_lines, 1, 0), ("y2", y_lines, 0, 1)]:
+        jaw_relative = relative[:, :, offsets.jaws.index(jaw)]
+        for offset in jaw_relative[~np.isnan(jaw_relative)]:
+            lines.append((a, b, -offset))    #absolute offset crosses zero
+        for t in [-0.75, -0.5, 0.5, 0.75]:
+            lines.append((a, b, t))    #lrfc jaw displacement thresholds
+
+    for g in [50, 130, 310, 230]:
+        for g_x1 in [0, 180]:
+            junction_gap = relative[offsets.index(g, 90, "x2")] + relative[offsets.index(g_x1, 90, "x1")]
+            for t in [-0.9, 0, 0.9]:
+                x_lines.append((1, 1, t - junction_gap))
+
+    for lrfc_val in (lrfc_vals or []):
+        for t in [0.4, 0.7]:
+            x_lines.append((-1, 1, 2*(t - lrfc_val[0][1]) - offsets.get(0, 0, "x1") + offsets.get(0, 0, "x2")))
+            y_lines.append((1, -1, 2*(t - lrfc_val[0][0]) + offsets.get(0, 0, "y1") - offsets.get(0, 0, "y2")))
+
+    #all lines are at multiples of 45 degrees, so probing at 22.5 degrees between them reaches every region around a vertex
+    angles = np.pi/8 + np.arange(8)*np.pi/4
+    probe_u = np.concatenate([[0], np.cos(angles)]) * 1e-9
+    probe_v = np.concatenate([[0], np.sin(angles)]) * 1e-9
+
+    opt_offset = []
+    opt_cost = 0
+    for jaws, lines, (u_bounds, v_bounds) in [(["x1", "x2"], x_lines, bounds[:2]), (["y1", "y2"], y_lines, bounds[2:])]:
+        lines = np.array(lines + [(1, 0, u_bounds[0]), (1, 0, u_bounds[1]), (0, 1, v_bounds[0]), (0, 1, v_bounds[1])], dtype=float)
+        a, b, c = lines.T
+        i, j = np.triu_indices(len(lines), k=1)
+        det = a[i]*b[j] - a[j]*b[i]
+        i, j, det = i[det != 0], j[det != 0], det[det != 0]
+        u = (c[i]*b[j] - c[j]*b[i]) / det
+        v = (a[i]*c[j] - a[j]*c[i]) / det
+        inside = (u >= u_bounds[0] - 1e-12) & (u <= u_bounds[1] + 1e-12) & (v >= v_bounds[0] - 1e-12) & (v <= v_bounds[1] + 1e-12)
+
+        points_u = np.clip((u[inside,None] + probe_u).ravel(), u_bounds[0], u_bounds[1])
+        points_v = np.clip((v[inside,None] + probe_v).ravel(), v_bounds[0], v_bounds[1])
+        cost = np.broadcast_to(block_cost({jaws[0]: points_u, jaws[1]: points_v}), points_u.shape)
+        k = np.argmin(cost)
+        opt_offset += [points_u[k], points_v[k]]
+        opt_cost += cost[k]
+
+    #the block optima only combine if there are no cross terms between x and y jaws. Check at the optimum and the corners of the bounds
+    check_points = np.array([opt_offset] + [[bounds[0,i], bounds[1,j], bounds[2,k], bounds[3,l]] for i, j, k, l in [(0,0,0,0), (1,1,1,1), (0,1,1,0), (1,0,0,1)]])
+    joint_cost = block_cost({jaw: check_points[:,i] for i, jaw in enumerate(["x1", "x2", "y1", "y2"])})
+    block_costs = block_cost({"x1": check_points[:,0], "x2": check_points[:,1]}) + block_cost({"y1": check_points[:,2], "y2": check_points[:,3]})
+    if np.amax(np.abs(joint_cost - block_costs)) > 1e-9:
+        print(f"Cost function is not separable into x and y jaws (largest cross term: {np.amax(np.abs(joint_cost - block_costs))})")
+        return None, None
+
+    return np.array(opt_offset), opt_cost
+
+def load_lrfc_points(lrfc_folder):
+    #measures the radiation/light field coincidence in each image of lrfc_folder (see lrfc_test.lrfc)
+    #returns {"vals": [[rad_disp, jaw_disps], ...], "field_sizes": [...]}
+    lrfc_vals = []
+    lrfc_field_sizes = []
+    for file in os.listdir(lrfc_folder):
+        lrfc_file = os.path.join(lrfc_folder, file)
+        lrfc_points= lrfc(lrfc_file)
+        lrfc_vals.append([lrfc_points["rad_disp"], lrfc_points["jaw_disps"]])
+        lrfc_field_sizes.append(lrfc_points["field_size"])
+    return {"vals": lrfc_vals, "field_sizes": lrfc_field_sizes}
+
+def get_missing_cost_offsets(offsets, optimize_junctions=True):
+    #lists the (gantry, collimator, jaw) offsets the cost function needs but that weren't measured (nan or not in the table): the g0c0 jaws every 
+    #offset is taken relative to, and the junction offsets (g0/g180 c90 x1 and g50/130/310/230 c90 x2) if optimize_junctions. Other offsets may be 
+    #missing, they are just left out of the absolute cost
+    offsets = as_offset_table(offsets)
+    required = [(0, 0, jaw) for jaw in offsets.jaws]
+    if optimize_junctions:
+        required += [(g, 90, "x1") for g in [0, 180]] + [(g, 90, "x2") for g in [50, 130, 310, 230]]
+    missing = []
+    for g, c, jaw in required:
+        if g not in offsets or c not in offsets.coll_angles or np.any(np.isnan(offsets.get(g, c, jaw))):
+            missing.append((g, c, jaw))
+    return missing
+
+def search_opt_offset(offsets, iters, search="grid", search_tol=0.005, workers=1, lrfc_vals=None, junction_priority=0.5, optimize_junctions=True, grid_file=None, top_k=10, plateau_tol=0.01):
+    #finds the optimal calibration shift with the chosen search (see get_opt_origin) over the grid iters = [x1_iters, x2_iters, y1_iters, y2_iters]
+    #grid_file - if given, the full grid is evaluated in chunks into this memory mapped file (see get_cost_grid_memmap) rather than held in memory
+    #returns {"opt_offset": [x1, x2, y1, y2], "cost_vals": full cost grid (None unless the full grid was evaluated), "cost_x1_x2" and "cost_y1_y2": cost slices through the optimum,
+    #   "components": the unweighted cost terms over the grid, which reweight_cost_grid can re-weight for a different junction_priority (None unless the full grid was evaluated in memory),
+    #   "grid_file": file holding the cost grid (None unless grid_file was used),
+    #   "candidates": the top_k lowest cost grid points [(cost, grid index), ...] and "plateau": the range of each jaw's shift within plateau_tol of the 
+    #   minimum (see CandidateTracker, both None unless the full grid was evaluated)}
+    missing = get_missing_cost_offsets(offsets, optimize_junctions=optimize_junctions)
+    if missing:
+        raise ValueError(f"Can't optimize the calibration point without the offsets for (gantry, collimator, jaw): {missing} (missing image or jaw edge not found)")
+
+    x1_iters, x2_iters, y1_iters, y2_iters = iters
+    cost_kwargs = {"lrfc_vals": lrfc_vals, "junction_priority": junction_priority, "optimize_junctions": optimize_junctions}
+    opt_offset = None
+    cost_vals = None
+    components = None
+    used_grid_file = None
+    candidates = None
+    plateau = None
+    if search == "separable":
+        opt_offset_ind = get_separable_optimum(offsets, iters, **cost_kwargs)
+        if opt_offset_ind is None:
+            print("Falling back to full grid search")
+        else:
+            opt_offset = [iters[i][opt_offset_ind[i]] for i in range(4)]
+    elif search == "adaptive":
+        opt_offset, _ = get_adaptive_optimum(offsets, [[-0.49, 0.49]]*4, tol=search_tol, num_points=[len(jaw_iters) for jaw_iters in iters], **cost_kwargs)
+    elif search == "exact":
+        opt_offset, _ = get_exact_optimum(offsets, [[-0.49, 0.49]]*4, **cost_kwargs)
+        if opt_offset is None:
+            print("Falling back to full grid search")
+
+    if opt_offset is None and grid_file is not None:
+        grid_result = get_cost_grid_memmap(offsets, iters, grid_file, top_k=top_k, plateau_tol=plateau_tol, **cost_kwargs)
+        opt_offset = grid_result["opt_offset"]
+        opt_offset_ind = grid_result["top_k"][0][1]
+        used_grid_file = grid_file
+        candidates = grid_result["top_k"]
+        plateau = grid_result["plateau"]
+        #only the two plotted slices are read from the file
+        cost_file = np.load(grid_file, mmap_mode="r")
+        cost_x1_x2 = np.array(cost_file[:,:,opt_offset_ind[2], opt_offset_ind[3]], dtype=float)
+        cost_y1_y2 = np.array(cost_file[opt_offset_ind[0], opt_offset_ind[1],:,:], dtype=float)
+        del cost_file
+    elif opt_offset is None:
+        #each x1 slab of the cost terms is weighted and added to the candidate tracker as it is evaluated, rather than scanning the whole grid afterwards.
+        #The cost terms are kept so the grid can be re-weighted later without being recalculated
+        grid_shape = tuple(len(iters_) for iters_ in iters)
+        cost_vals = np.empty(grid_shape)
+        tracker = CandidateTracker(iters, top_k=top_k, plateau_tol=plateau_tol)
+        component_slabs = []
+        for start, component_slab in iter_cost_slabs(offsets, iters, workers=workers, return_components=True, **cost_kwargs):
+            slab_cost = combine_cost_components(component_slab, junction_priority, optimize_junctions=optimize_junctions)
+            cost_slab = cost_vals[start:start + np.shape(slab_cost)[0]]
+            cost_slab[...] = slab_cost
+            tracker.update(cost_slab, start=(start, 0, 0, 0))
+            component_slabs.append(component_slab)
+        #every term depends on x1, so the slabs of each term join along the x1 axis
+        components = {name: np.concatenate([slab[name] for slab in component_slabs], axis=0) for name in component_slabs[0]}
+
+        #best cost = minimum value (ties go to the first grid point)
+        candidates = tracker.candidates()
+        opt_offset_ind = candidates[0][1]
+        opt_offset = [iters[i][opt_offset_ind[i]] for i in range(4)]
+        plateau = tracker.plateau()
+        cost_x1_x2 = cost_vals[:,:,opt_offset_ind[2], opt_offset_ind[3]]
+        cost_y1_y2 = cost_vals[opt_offset_ind[0], opt_offset_ind[1],:,:]
+    else:
+        #cost slices through the optimum for plotting
+        cost_x1_x2 = get_cost_grid(offsets, [x1_iters, x2_iters, [opt_offset[2]], [opt_offset[3]]], **cost_kwargs)[:,:,0,0]
+        cost_y1_y2 = get_cost_grid(offsets, [[opt_offset[0]], [opt_offset[1]], y1_iters, y2_iters], **cost_kwargs)[0,0,:,:]
+
+    return {"opt_offset": opt_offset, "cost_vals": cost_vals, "cost_x1_x2": cost_x1_x2, "cost_y1_y2": cost_y1_y2, "components": components,
+            "grid_file": used_grid_file, "candidates": candidates, "plateau": plateau}
+
+def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrfc_folder=None, optimize_junctions=True, search="grid", search_tol=0.005, workers=1, lrfc_points=None, checkpoints=None, sweep_priorities=None, monte_carlo_samples=0, monte_carlo_sigma=0.1, grid_shape=(31, 31, 21, 21), grid_file=None, top_k=10, plateau_tol=0.01):
     #this function takes the offset dictionary (for each gantry angle, each collimator angle, each jaw) and computes the optimal calibration point.
     # our primary objective is to minimize the sum of gaps between g0c90, g180c90 - x2 and off axis gantry angles w/ collimator 90 and x1
     #
     #Variables:
-    #offsets (dict)
+    #offsets (OffsetTable or dict)
     #junction_priority (default 0.8) - the fraction of the total gap "cost function" that is given to sum of junction gaps/overlaps. 
     #
     # The remaining fraction (1-junction_priority) will go towards minimizing the absolute value of all jaw offsets at each angle.
-
-    #This function works by iterating through a set of possible calibration points (from -1 mm to 1mm across isocentre  in x/y direction) and
-    #calculating the new jaw offsets each time and subsequent cost function
-    #the cost function will be stored for each iteration, and finally, the cal point giving the minimum cost will be returned
-
-    x1_iters = np.linspace(-0.49,0.49,31)
-    x2_iters = np.linspace(-0.49,0.49,31)
-    y1_iters = np.linspace(-0.49,0.49,21)
-    y2_iters = np.linspace(-0.49,0.49,21)
-    cost_vals = np.zeros((31,31,21,21))    #save as 2d grid with first dimension = x, second dimension = y
+    #
+    #returns the optimal (x1, x2, y1, y2) calibration shift and an OffsetTable of the new offsets after the shift
+    #
+    #search (default "grid") - "grid" evaluates the full x1/x2/y1/y2 grid, "separable" searches the x1/x2 and y1/y2 grids separately
+    #   (falls back to the full grid if the cost couples the x and y jaws), "adaptive" does a coarse to fine search down to search_tol (mm),
+    #   "exact" solves for the continuous optimum directly from the breakpoints of the piecewise linear cost
+    #workers (default 1) - number of processes used to evaluate the full grid (None for all cores)
+    #lrfc_points - lrfc measurements already loaded with load_lrfc_points (otherwise loaded from lrfc_folder)
+    #checkpoints - optional StageCheckpoints, so the search result is reused when the offsets and search settings haven't changed
+    #sweep_priorities - optional list of junction priorities to also find the optimum for, written with the junction/absolute cost pareto front to junction_priority_sweep_*.csv
+    #monte_carlo_samples (default 0) - number of perturbed offset tables (noise of monte_carlo_sigma mm) to re-solve for the spread of the optimal shift, written to monte_carlo_shifts_*.csv
+    #grid_shape (default (31, 31, 21, 21)) - number of x1, x2, y1, y2 grid points between -0.49 and 0.49 mm
+    #grid_file - optional .npy file to evaluate the full grid into in chunks (memory mapped), for grids too fine to hold in memory
+    #top_k (default 10), plateau_tol (default 0.01) - the top_k lowest cost grid points (with their cost breakdown) and the range of each jaw's shift with 
+    #   cost within plateau_tol of the minimum are listed in the csv as alternatives to the optimum (full grid search only)
+
+    #This function works by evaluating the cost function over a grid of possible calibration points (from -0.5 mm to 0.5mm across isocentre in x/y direction).
+    #The whole grid is evaluated at once with get_cost_grid (vectorized form of calculate_cost on the shifted offsets at each point),
+    #and finally, the cal point giving the minimum cost will be returned
+
+    offsets = as_offset_table(offsets)
+
+    x1_iters = np.linspace(-0.49,0.49,grid_shape[0])
+    x2_iters = np.linspace(-0.49,0.49,grid_shape[1])
+    y1_iters = np.linspace(-0.49,0.49,grid_shape[2])
+    y2_iters = np.linspace(-0.49,0.49,grid_shape[3])
 
     #so for each iteration, first calculate the new offsets after shifting each jaw by respective amount
     #assume x and y vectors are in same direction as image vectors (so y1 > y2 in image - aka if calibration iso shifts by -1, then y1 would increase and y2 would decrease)
-    if lrfc_folder is not None:
+    if lrfc_points is None and lrfc_folder is not None:
+        lrfc_points = load_lrfc_points(lrfc_folder)
+    if lrfc_points is not None:
         use_lrfc = True
-        lrfc_vals = []
-        lrfc_field_sizes = []
-        for file in os.listdir(lrfc_folder):
-            lrfc_file = os.path.join(lrfc_folder, file)
-            lrfc_points= lrfc(lrfc_file)
-            lrfc_vals.append([lrfc_points["rad_disp"], lrfc_points["jaw_disps"]])
-            lrfc_field_sizes.append(lrfc_points["field_size"])
+        lrfc_vals = lrfc_points["vals"]
+        lrfc_field_sizes = lrfc_points["field_sizes"]
     else:
         use_lrfc = False
+        lrfc_vals = []
 
-    #in service mode, jaws must be calibrated at g = 0 and c = 0, so need to calculate the new offsets in terms of shift from original offsets at g0c0 to iso
-    for x1_ind, x1 in enumerate(x1_iters):
-        for y1_ind, y1 in enumerate(y1_iters):
-            for y2_ind, y2 in enumerate(y2_iters):
-                for x2_ind, x2 in enumerate(x2_iters):
-                    new_offsets = deepcopy(offsets)
-                    for g in offsets.keys():
-                        for c in offsets[g].keys():
-                            if c == "iso":
-                                continue
-                            try:
-                                new_offsets[g][c]["x1"] = offsets[g][c]["x1"] - offsets[0][0]["x1"] + x1   #difference in offset from the calibration position + the cal position offset from isocentre
-                            except: pass
-                            try:
-                                new_offsets[g][c]["x2"] = offsets[g][c]["x2"]- offsets[0][0]["x2"] + x2
-                            except: pass
-                            try:
-                                new_offsets[g][c]["y1"] = offsets[g][c]["y1"]- offsets[0][0]["y1"] + y1
-                            except: pass
-                            try:
-                                new_offsets[g][c]["y2"] = offsets[g][c]["y2"]- offsets[0][0]["y2"] + y2
-                            except: pass
-
-                    #now compute the cost
-                    cost = calculate_cost(new_offsets, offsets, use_lrfc, lrfc_vals, junction_priority=junction_priority, optimize_junctions=optimize_junctions)
-                    cost_vals[x1_ind, x2_ind, y1_ind, y2_ind] = cost
-
-
-     #best cost = minimum value
-    opt_offset_ind = np.argwhere(cost_vals == np.amin(cost_vals))
-
-    opt_offset_x1 = x1_iters[opt_offset_ind[0,0]]
-    opt_offset_x2 = x2_iters[opt_offset_ind[0,1]]
-    opt_offset_y1 = y1_iters[opt_offset_ind[0,2]]
-    opt_offset_y2 = y2_iters[opt_offset_ind[0,3]]
+    #in service mode, jaws must be calibrated at g = 0 and c = 0, so new offsets are calculated in terms of shift from original offsets at g0c0 to iso
+    iters = [x1_iters, x2_iters, y1_iters, y2_iters]
+    cost_kwargs = {"lrfc_vals": lrfc_vals if use_lrfc else None, "junction_priority": junction_priority, "optimize_junctions": optimize_junctions}
+    if checkpoints is None:
+        checkpoints = StageCheckpoints(None)
+    result = checkpoints.run("optimization", search_opt_offset, offsets, iters, search=search, search_tol=search_tol, workers=workers, grid_file=grid_file, top_k=top_k,
+                             plateau_tol=plateau_tol, **cost_kwargs, key_inputs=(offsets, iters, search, search_tol, cost_kwargs, grid_file, top_k, plateau_tol))
+    opt_offset = result["opt_offset"]
+    cost_x1_x2 = result["cost_x1_x2"]
+    cost_y1_y2 = result["cost_y1_y2"]
+
+    if sweep_priorities is not None:
+        components = result["components"]
+        if components is None:    #only kept by the full grid search
+            components = get_cost_grid_parallel(offsets, iters, workers=workers, return_components=True, **cost_kwargs)
+        sweep, front = sweep_junction_priority(components, iters, sweep_priorities, optimize_junctions=optimize_junctions)
+        write_priority_sweep_csv(sweep, front, unit_num)
+
+    if monte_carlo_samples > 0:
+        opt_shifts = get_monte_carlo_shifts(offsets, iters, num_samples=monte_carlo_samples, sigma=monte_carlo_sigma, **cost_kwargs)
+        if opt_shifts is not None:
+            write_monte_carlo_csv(opt_shifts, monte_carlo_sigma, unit_num)
+
+    opt_offset_x1, opt_offset_x2, opt_offset_y1, opt_offset_y2 = opt_offset
 
 
 
@@ -958,9 +1645,9 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
 
     
     fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(15, 15))
-    ax[0].imshow(cost_vals[:,:,opt_offset_ind[0,2], opt_offset_ind[0,3]], cmap='rainbow')
-    x_ticks = [2.5, 5, 7.5, 10, 12.5, 15, 17.5, 20, 22.5, 25, 27.5, 30]
-    y_ticks = [2.5, 5, 7.5, 10, 12.5, 15, 17.5, 20, 22.5, 25, 27.5, 30]
+    ax[0].imshow(cost_x1_x2, cmap='rainbow')
+    x_ticks = [2.5*k*(len(x1_iters)-1)/30 for k in range(1, 13)]    #[2.5, 5, ... 30] for the default 31 point grid
+    y_ticks = [2.5*k*(len(x2_iters)-1)/30 for k in range(1, 13)]
     x_labels = []
     y_labels = []
     ax[0].set_xticks(x_ticks)
@@ -979,8 +1666,8 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
     ax[0].set_ylabel("X2 Displacement from Iso (mm)", fontsize=16)
 
     #also show the cost values with colormap levelled
-    vmax = np.amax(cost_vals[:,:,opt_offset_ind[0,2], opt_offset_ind[0,3]]) - 0.95 * (np.amax(cost_vals[:,:,opt_offset_ind[0,2], opt_offset_ind[0,3]]) - np.amin(cost_vals[:,:,opt_offset_ind[0,2], opt_offset_ind[0,3]]))
-    ax[1].imshow(np.log(cost_vals[:,:,opt_offset_ind[0,2], opt_offset_ind[0,3]]), cmap='rainbow')#.imshow(cost_vals[:,:,opt_offset_ind[0,2], opt_offset_ind[0,3]], cmap='rainbow', vmax=vmax)
+    vmax = np.amax(cost_x1_x2) - 0.95 * (np.amax(cost_x1_x2) - np.amin(cost_x1_x2))
+    ax[1].imshow(np.log(cost_x1_x2), cmap='rainbow')#.imshow(cost_x1_x2, cmap='rainbow', vmax=vmax)
     ax[1].set_xticklabels(x_labels)
     ax[1].set_yticklabels(y_labels)
     ax[1].set_xlabel("X1 Displacement from Iso (mm)", fontsize=16)
@@ -994,9 +1681,9 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
 
    #now plot y1,y2 cost
     fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(15, 15))
-    ax[0].imshow(cost_vals[opt_offset_ind[0,0], opt_offset_ind[0,1],:,:], cmap='rainbow')
-    x_ticks = [2.5, 5, 7.5, 10, 12.5, 15, 17.5, 20]
-    y_ticks = [2.5, 5, 7.5, 10, 12.5, 15, 17.5, 20]
+    ax[0].imshow(cost_y1_y2, cmap='rainbow')
+    x_ticks = [2.5*k*(len(y1_iters)-1)/20 for k in range(1, 9)]    #[2.5, 5, ... 20] for the default 21 point grid
+    y_ticks = [2.5*k*(len(y2_iters)-1)/20 for k in range(1, 9)]
     x_labels = []
     y_labels = []
     ax[0].set_xticks(x_ticks)
@@ -1015,8 +1702,8 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
     ax[0].set_ylabel("Y2 Displacement from Iso (mm)", fontsize=16)
 
     #also show the cost values with colormap levelled
-    vmax = np.amax(cost_vals[opt_offset_ind[0,0], opt_offset_ind[0,1],:,:]) - 0.95 * (np.amax(cost_vals[opt_offset_ind[0,0], opt_offset_ind[0,1],:,:]) - np.amin(cost_vals[opt_offset_ind[0,0], opt_offset_ind[0,1],:,:]))
-    ax[1].imshow(np.log(cost_vals[opt_offset_ind[0,0], opt_offset_ind[0,1],:,:]), cmap='rainbow')#.imshow(cost_vals[opt_offset_ind[0,0], opt_offset_ind[0,1],:,:], cmap='rainbow', vmax=vmax)
+    vmax = np.amax(cost_y1_y2) - 0.95 * (np.amax(cost_y1_y2) - np.amin(cost_y1_y2))
+    ax[1].imshow(np.log(cost_y1_y2), cmap='rainbow')#.imshow(cost_y1_y2, cmap='rainbow', vmax=vmax)
     ax[1].set_xticklabels(x_labels)
     ax[1].set_yticklabels(y_labels)
     ax[1].set_xlabel("Y1 Displacement from Iso (mm)", fontsize=16)
@@ -1028,16 +1715,7 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
 
 
     #recalculate optimal offsets
-    new_offsets = deepcopy(offsets)
-    for g in offsets.keys():
-        for c in [0, 90]:#offsets[g].keys(): #removed 270
-            if c == "iso": 
-                continue
-            new_offsets[g][c]["x1"] = offsets[g][c]["x1"] - offsets[0][0]["x1"] + opt_offset_x1   #difference in offset from the calibration position + the cal position offset from isocentre
-            new_offsets[g][c]["x2"] = offsets[g][c]["x2"]- offsets[0][0]["x2"] + opt_offset_x2
-
-            new_offsets[g][c]["y1"] = offsets[g][c]["y1"]- offsets[0][0]["y1"] + opt_offset_y1
-            new_offsets[g][c]["y2"] = offsets[g][c]["y2"]- offsets[0][0]["y2"] + opt_offset_y2
+    new_offsets = offsets.shifted(opt_offset)
 
     disp_x1 = new_offsets[0][0]["x1"] - offsets[0][0]["x1"]
     disp_x2 = new_offsets[0][0]["x2"] - offsets[0][0]["x2"]
@@ -1068,24 +1746,39 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
         writer.writerow(["y2", str(offsets[0][0]["y2"]), str(opt_offset_y2)])
         writer.writerow(["Junction", "Original Offset", "Final Offset"])
 
-        #calculate the junctions
-        g0c90_x1 = offsets[0][90]["x1"]
-        g180c90_x1 = offsets[180][90]["x1"]
+        #calculate the junctions (junctions with an unmeasured jaw, only possible without optimize_junctions, are left blank)
+        def blank_if_nan(val):
+            return "" if np.isnan(val) else val
+        g0c90_x1 = offsets.get(0, 90, "x1")
+        g180c90_x1 = offsets.get(180, 90, "x1")
 
-        g0c90_x1_final = new_offsets[0][90]["x1"]
-        g180c90_x1_final = new_offsets[180][90]["x1"]
+        g0c90_x1_final = new_offsets.get(0, 90, "x1")
+        g180c90_x1_final = new_offsets.get(180, 90, "x1")
         for g in [50, 130, 310, 230]:    #just the breast tangent angles for calculating junctions
-            lower_x2 = offsets[g][90]["x2"]
+            lower_x2 = offsets.get(g, 90, "x2")
             junction_gap_0 = lower_x2 + g0c90_x1  #adding together will give the total error from perfect junction (whether it's a gap or an overlap)
             junction_gap_180 = lower_x2 + g180c90_x1
 
-            lower_x2_final = new_offsets[g][90]["x2"]
+            lower_x2_final = new_offsets.get(g, 90, "x2")
             junction_gap_0_final = lower_x2_final + g0c90_x1_final  #adding together will give the total error from perfect junction (whether it's a gap or an overlap)
             junction_gap_180_final = lower_x2_final + g180c90_x1_final
 
             #now add these junctions to the csv
-            writer.writerow([f"g0c90_x1 and g{g}c90_x2", junction_gap_0, junction_gap_0_final])
-            writer.writerow([f"g180c90_x1 and g{g}c90_x2", junction_gap_180, junction_gap_180_final])
+            writer.writerow([f"g0c90_x1 and g{g}c90_x2", blank_if_nan(junction_gap_0), blank_if_nan(junction_gap_0_final)])
+            writer.writerow([f"g180c90_x1 and g{g}c90_x2", blank_if_nan(junction_gap_180), blank_if_nan(junction_gap_180_final)])
+        #list the other low cost calibration points, with their cost breakdown
+        if result["candidates"] is not None:
+            writer.writerow(["","",""])
+            writer.writerow([f"Alternative Calibration Points (top {len(result['candidates'])})"])
+            writer.writerow(["Rank", "X1", "X2", "Y1", "Y2", "Absolute Cost", "Junction Cost", "Cold Junction Cost", "LRFC Cost", "Total Cost"])
+            candidate_shifts = np.array([[iters[i][grid_ind[i]] for i in range(4)] for _, grid_ind in result["candidates"]])
+            breakdown = get_cost_components(offsets, {jaw: candidate_shifts[:,j] for j, jaw in enumerate(offsets.jaws)}, lrfc_vals=cost_kwargs["lrfc_vals"])
+            for rank, (cost, _) in enumerate(result["candidates"]):
+                terms = [blank_if_nan(breakdown[name][rank]) if name in breakdown else 0 for name in ["absolute", "junction", "cold_junction", "lrfc"]]
+                writer.writerow([rank+1] + list(candidate_shifts[rank]) + terms + [cost])
+            writer.writerow([f"Near Optimal Range (cost within {plateau_tol} of minimum)", "Lowest", "Highest"])
+            for jaw in ["x1", "x2", "y1", "y2"]:
+                writer.writerow([jaw.upper()] + list(result["plateau"][jaw]))
         #now that junctions have been included, add all the offset values
         if use_lrfc:
             writer.writerow(["","",""])
@@ -1112,7 +1805,10 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
             for c in [0,90]:#offsets[g].keys(): taking out 270
                 if c == "iso":
                     continue
-                writer.writerow([g,c,offsets[g][c]["x1"],new_offsets[g][c]["x1"], offsets[g][c]["x2"],new_offsets[g][c]["x2"], offsets[g][c]["y1"],new_offsets[g][c]["y1"], offsets[g][c]["y2"],new_offsets[g][c]["y2"]])
+                #jaws that weren't measured are missing from the table's dictionary view, and are left blank
+                original = offsets[g].get(c, {})
+                final = new_offsets[g].get(c, {})
+                writer.writerow([g,c,original.get("x1", ""),final.get("x1", ""), original.get("x2", ""),final.get("x2", ""), original.get("y1", ""),final.get("y1", ""), original.get("y2", ""),final.get("y2", "")])
         if jaw_offsets is not None:
             writer.writerow(["","",""])
             writer.writerow(["Asymmetric Jaw Measurements"])
@@ -1139,35 +1835,68 @@ def get_opt_origin(offsets : dict, jaw_offsets, junction_priority, unit_num, lrf
 
     return tuple((opt_offset_x1, opt_offset_x2, opt_offset_y1, opt_offset_y2)), new_offsets
 
-def predict_optimal_encoders(date, unit_num, junction_priority, img_folder, jaw_pos_folder, enc_img_folder, enc_iso_img_path, lrfc_folder, optimize_junctions=True, epid_position=1.086):
+def get_junction_offset_table(img_folder, unit_num, manifest=None, workers=1, cache=None, store=None, coll_angles=(0, 90)):
+    #junction offset stage: sorts the closed jaw images and measures each jaw's offset from isocentre, returned as an OffsetTable
+    junc_img_dict = sort_junc_img_dict(img_folder, manifest=manifest, workers=workers, cache=cache, store=store, coll_angles=coll_angles)
+    return get_junc_offsets(junc_img_dict, unit_num, coll_angles=coll_angles)
+
+def get_jaw_offset_dict(jaw_pos_folder, isocentre, manifest=None, workers=1, cache=None, store=None):
+    #asymmetric jaw stage: sorts the jaw position images and measures each jaw's offset
+    jaw_img_dict = sort_jaw_img_dict(jaw_pos_folder, manifest=manifest, workers=workers, cache=cache, store=store)
+    return get_jaw_offsets(jaw_img_dict, isocentre)
+
+def predict_optimal_encoders(date, unit_num, junction_priority, img_folder, jaw_pos_folder, enc_img_folder, enc_iso_img_path, lrfc_folder, optimize_junctions=True, epid_position=1.086, search="grid", workers=1, cache_dir=None, checkpoint_dir=None, sweep_priorities=None, monte_carlo_samples=0, monte_carlo_sigma=0.1, grid_shape=(31, 31, 21, 21), grid_file=None, top_k=10, plateau_tol=0.01, image_dtype=np.float32):
+    #cache_dir - optional folder for a persistent cache of preprocessed images (see ImageCache), so re-runs on the same images skip the image preprocessing
+    #checkpoint_dir - optional folder where the output of each stage (junction offsets, jaw offsets, lrfc points, optimization) is saved (see StageCheckpoints).
+    #   A re-run (e.g. after the encoder fit fails) reuses every stage whose inputs haven't changed and resumes from the first stale one
+    #sweep_priorities - optional list of junction priorities for the junction priority sweep (see get_opt_origin)
+    #monte_carlo_samples, monte_carlo_sigma - number of samples and offset noise (mm) for the uncertainty in the optimal shift (see get_opt_origin)
+    #grid_shape, grid_file - size of the calibration point grid and optional file to evaluate it into for fine grids (see get_opt_origin)
+    #top_k, plateau_tol - number of alternative calibration points and cost tolerance of the near optimal range reported in the csv (see get_opt_origin)
+    #image_dtype - type the preprocessed images are held as (see ImageStore)
 
     if not os.path.exists(os.path.join(os.getcwd(), f"U{unit_num}_Output")):
         os.mkdir(os.path.join(os.getcwd(), f"U{unit_num}_Output"))
+    cache = ImageCache(cache_dir) if cache_dir is not None else None
+    checkpoints = StageCheckpoints(checkpoint_dir)
+    store = ImageStore(dtype=image_dtype)
 
-    #first collect imgs for closed jaws:
-    junc_img_dict = sort_junc_img_dict(img_folder)
-    #also get images for asymmetric jaw positions
-    if jaw_pos_folder is not None:
-        jaw_img_dict = sort_jaw_img_dict(jaw_pos_folder)
-
+    #index and check the image headers of every stage first, so duplicate, missing or unreadable images are flagged before any pixel data is processed
+    junc_manifest = check_junction_manifest(index_image_folder(img_folder))
+    jaw_manifest = check_jaw_manifest(index_image_folder(jaw_pos_folder)) if jaw_pos_folder is not None else None
+    enc_manifest = check_encoder_manifest(index_image_folder(enc_img_folder))
 
     #fit_encoder_vs_pixel_funcs(enc_img_folder, enc_iso_img_path, unit_num=unit_num, optimal_cal=[0.1, 0.1, -0.5, -0.3])
-    # #now want to define the offset of each 1/4 blocked beam's jaw from isocentre at each gantry/collimator combination
-    junc_offsets = get_junc_offsets(junc_img_dict, unit_num)
+    # #now want to define the offset of each 1/4 blocked beam's jaw from isocentre at each gantry/collimator combination (from the imgs for closed jaws)
+    junc_offsets = checkpoints.run("junction_offsets", get_junction_offset_table, img_folder, unit_num, manifest=junc_manifest, workers=workers, cache=cache,
+                                   store=store, key_inputs=(junc_manifest, unit_num, store.dtype.str))
+    #also get images for asymmetric jaw positions
     if jaw_pos_folder is not None:
         isocentre = junc_offsets[0]["iso"]
-        jaw_offsets = get_jaw_offsets(jaw_img_dict, isocentre)
+        jaw_offsets = checkpoints.run("jaw_offsets", get_jaw_offset_dict, jaw_pos_folder, isocentre, manifest=jaw_manifest, workers=workers, cache=cache,
+                                      store=store, key_inputs=(jaw_manifest, isocentre, store.dtype.str))
     else:
         jaw_offsets = None
+    if lrfc_folder is not None:
+        lrfc_points = checkpoints.run("lrfc_points", load_lrfc_points, lrfc_folder, key_inputs=index_image_folder(lrfc_folder))
+    else:
+        lrfc_points = None
 
     # #now find the optimal calibration point (relative to g = 0, c = 0 isocentre image) to be used for calibration
-    optimal_cal, new_offsets = get_opt_origin(junc_offsets, jaw_offsets, junction_priority, unit_num, lrfc_folder=lrfc_folder, optimize_junctions=optimize_junctions)    #x1,x2,y1,y2
+    optimal_cal, new_offsets = get_opt_origin(junc_offsets, jaw_offsets, junction_priority, unit_num, optimize_junctions=optimize_junctions, search=search, workers=workers,
+                                              lrfc_points=lrfc_points, checkpoints=checkpoints, sweep_priorities=sweep_priorities,
+                                              monte_carlo_samples=monte_carlo_samples, monte_carlo_sigma=monte_carlo_sigma, grid_shape=grid_shape, grid_file=grid_file,
+                                              top_k=top_k, plateau_tol=plateau_tol)    #x1,x2,y1,y2
     print(f"Optimal Calibration Shift: {optimal_cal}")
     # optimal_cal = [0.5,1,-0.5,-1]
 
     #now get jaw images to use for encoder-jaw correlations
 
-    fit_encoder_vs_pixel_funcs(date, enc_img_folder, enc_iso_img_path, unit_num=unit_num, optimal_cal=optimal_cal, epid_position=epid_position)
+    fit_encoder_vs_pixel_funcs(date, enc_img_folder, enc_iso_img_path, unit_num=unit_num, optimal_cal=optimal_cal, epid_position=epid_position, manifest=enc_manifest, workers=workers, cache=cache)
+    if cache is not None:
+        cache.report()
+    store.report()
+    derived_results.report()
 
 # import random
 # a = np.ones((1000,100))
@@ -1175,22 +1904,38 @@ def predict_optimal_encoders(date, unit_num, junction_priority, img_folder, jaw_
 #     a[i*10,i] = random.random()*0.5
 # vals = find_half_intensity_pixel(a)
 
-unit_num=3
-junction_priority=0.7
-optimize_junctions = True
-date="feb18"
-pre_or_post = "pre"
-epid_position = 1.086
-
-img_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_{pre_or_post}_{date}")
-lrfc_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_lrfc_{pre_or_post}_{date}")
-
-enc_img_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_encoders_{date}")
-enc_iso_img_path = os.path.join(os.getcwd(), "Images", f"U{unit_num}_iso_encoder_{date}.dcm")
-
-jaw_pos_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_jaws_{pre_or_post}_{date}")
-
-predict_optimal_encoders(date, unit_num, junction_priority, img_folder, jaw_pos_folder, enc_img_folder, enc_iso_img_path, lrfc_folder, optimize_junctions=optimize_junctions, epid_position=epid_position)
-
-
-print("Program Finished Successfully")
\ No newline at end of file
+#guard the script so worker processes (which re-import this module on windows) don't re-run it
+if __name__ == "__main__":
+    unit_num=3
+    junction_priority=0.7
+    optimize_junctions = True
+    date="feb18"
+    pre_or_post = "pre"
+    epid_position = 1.086
+    search = "grid"    #"grid", "separable", "adaptive" or "exact"
+    workers = 1    #processes used for image preprocessing and the grid search (None for all cores)
+    cache_dir = None    #e.g. os.path.join(os.getcwd(), "Cache") to keep preprocessed images between runs
+    checkpoint_dir = None    #e.g. os.path.join(os.getcwd(), f"U{unit_num}_Checkpoints") to resume from the last completed stage
+    sweep_priorities = None    #e.g. np.linspace(0, 1, 11) to also report the optimum over a range of junction priorities
+    monte_carlo_samples = 0    #e.g. 2000 to report the spread of the optimal shift from offset measurement noise
+    monte_carlo_sigma = 0.1    #offset measurement noise (mm) for the monte carlo samples
+    grid_shape = (31, 31, 21, 21)    #x1, x2, y1, y2 grid points from -0.49 to 0.49 mm (e.g. (99, 99, 99, 99) for 0.01 mm steps, with a grid_file)
+    grid_file = None    #e.g. os.path.join(os.getcwd(), f"U{unit_num}_Output", "cost_grid.npy") to evaluate the grid into a memory mapped file
+    top_k = 10    #alternative calibration points listed in the csv
+    plateau_tol = 0.01    #cost tolerance for the near optimal range of each jaw
+    image_dtype = np.float32    #type the preprocessed images are held as (np.float64 for full precision)
+
+    img_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_{pre_or_post}_{date}")
+    lrfc_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_lrfc_{pre_or_post}_{date}")
+
+    enc_img_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_encoders_{date}")
+    enc_iso_img_path = os.path.join(os.getcwd(), "Images", f"U{unit_num}_iso_encoder_{date}.dcm")
+
+    jaw_pos_folder = os.path.join(os.getcwd(), "Images", f"U{unit_num}_jaws_{pre_or_post}_{date}")
+
+    predict_optimal_encoders(date, unit_num, junction_priority, img_folder, jaw_pos_folder, enc_img_folder, enc_iso_img_path, lrfc_folder, optimize_junctions=optimize_junctions, epid_position=epid_position, search=search, workers=workers, cache_dir=cache_dir, checkpoint_dir=checkpoint_dir, sweep_priorities=sweep_priorities,
+                             monte_carlo_samples=monte_carlo_samples, monte_carlo_sigma=monte_carlo_sigma, grid_shape=grid_shape, grid_file=grid_file,
+                             top_k=top_k, plateau_tol=plateau_tol, image_dtype=image_dtype)
+
+
+    print("Program Finished Successfully")
\ No newline at end of file
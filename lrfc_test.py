@@ -1,29 +1,24 @@
 import numpy as np
 import pydicom
-import copy
-from copy import deepcopy
 import os
 from scipy.ndimage import zoom, gaussian_filter
 import matplotlib.pyplot as plt
 from numpy.ma import masked_array 
 import warnings
+from image_utils import normalize_by_top_median, refine_dark_centroid
 warnings.filterwarnings("ignore")
 
-def normalize_by_top_median(img, num=10000):
-    #this function normalizes an image by the median of the top num of pixels
-    flattened = deepcopy(img).flatten()
-    sorted_pixels = np.sort(flattened)[::-1]
-    hottest = sorted_pixels[:num]
-    med=np.median(hottest)
-    return  img / med
-
-def find_bb(image, bounds=[[0,-1],[0,-1]], zoom_factor=3):
-    image = (copy.deepcopy(image) - np.amin(image)) / (np.amax(image) - np.amin(image))
-    #first crop image to within bounds:
-    img = copy.deepcopy(image)[bounds[0][0]:bounds[0][1], bounds[1][0]:bounds[1][1]]
+def find_bb(image, bounds=[[0,-1],[0,-1]], zoom_factor=3, refine_zoom=1):
+    #centre of the BB (darkest spot) within bounds, as the centroid of the darkest 50*zoom_factor**2 pixels. The threshold is picked with a partial sort.
+    #refine_zoom - if > 1, the centre is refined on a patch around it upsampled by this factor (see refine_dark_centroid)
+    #first crop image to within bounds, then normalize the crop (by the whole image's range) into a new array so the image itself isn't copied or changed:
+    img = (image[bounds[0][0]:bounds[0][1], bounds[1][0]:bounds[1][1]] - np.amin(image)) / (np.amax(image) - np.amin(image))
     min_pixel = np.argmin(img)
-    pixel_list = sorted(img.flatten().tolist())
-    pixel_100 = pixel_list[50*zoom_factor**2]
+    pixel_100 = np.partition(img, 50*zoom_factor**2, axis=None)[50*zoom_factor**2]
+    if refine_zoom > 1:
+        centre_of_mass = np.mean(np.nonzero((img <= pixel_100) & (img != 0)), axis=1)
+        centre_of_mass = refine_dark_centroid(img, centre_of_mass, 50*zoom_factor**2, refine_zoom=refine_zoom)
+        return [centre_of_mass[0] + bounds[0][0], centre_of_mass[1] + bounds[1][0]]
     img[img > pixel_100] = 0
 
     #now find the centre of mass of the remaining pixels 
@@ -44,7 +39,7 @@ def lrfc(image_path, zoom_factor=3):
     jaws_y = meta[0x3002,0x0030][0][0x300A,0x00B6][1][0x300A,0X011C].value
     image = meta.pixel_array
     #this function performs lrfc test on the given image, assuming both plates are present (the light field alignment plate and the crosshair plate)
-    image = normalize_by_top_median(image)
+    image = normalize_by_top_median(image, num=10000, skip=0)
     image = zoom(image, zoom=zoom_factor, order=3)
     points = {}    #hold the bb location points 
 
@@ -140,21 +135,21 @@ def lrfc(image_path, zoom_factor=3):
     # x1_pixel = int(0.5*(np.argmin(abs(x1_top_profile - 0.5))  +np.argmin(abs(x1_bottom_profile - 0.5))))
     # x2_pixel = int(0.5*(np.argmin(abs(x2_top_profile - 0.5)) + np.argmin(abs(x2_bottom_profile - 0.5))) + image.shape[1]/2)
 
-    #make a figure showing defined edges/BBs
-    img = deepcopy(image)
-    img[-20+ int(centre_bb[0]):20+int(centre_bb[0]), -20+ int(centre_bb[0]):20+int(centre_bb[0])] = -1
-    img[-20 + int(top_left_bb[0]):20 + int(top_left_bb[0]), -20 + int(top_left_bb[1]): 20 + int(top_left_bb[1])] = -1
-    img[-20 + int(top_right_bb[0]):20 + int(top_right_bb[0]), -20 + int(top_right_bb[1]): 20 + int(top_right_bb[1])] = -1
-    img[-20 + int(bottom_left_bb[0]):20 + int(bottom_left_bb[0]), -20 + int(bottom_left_bb[1]): 20 + int(bottom_left_bb[1])] = -1
-    img[-20 + int(bottom_right_bb[0]):20 + int(bottom_right_bb[0]), -20 + int(bottom_right_bb[1]): 20 + int(bottom_right_bb[1])] = -1
+    #make a figure showing defined edges/BBs (marked in a boolean mask rather than a copy of the image)
+    img = np.zeros(image.shape, dtype=bool)
+    img[-20+ int(centre_bb[0]):20+int(centre_bb[0]), -20+ int(centre_bb[0]):20+int(centre_bb[0])] = True
+    img[-20 + int(top_left_bb[0]):20 + int(top_left_bb[0]), -20 + int(top_left_bb[1]): 20 + int(top_left_bb[1])] = True
+    img[-20 + int(top_right_bb[0]):20 + int(top_right_bb[0]), -20 + int(top_right_bb[1]): 20 + int(top_right_bb[1])] = True
+    img[-20 + int(bottom_left_bb[0]):20 + int(bottom_left_bb[0]), -20 + int(bottom_left_bb[1]): 20 + int(bottom_left_bb[1])] = True
+    img[-20 + int(bottom_right_bb[0]):20 + int(bottom_right_bb[0]), -20 + int(bottom_right_bb[1]): 20 + int(bottom_right_bb[1])] = True
 
-    img[-10 + int(y1_pixel):10 + int(y1_pixel), int(img.shape[0]/3):int(img.shape[0]*2/3)] = -1
-    img[-10 + int(y2_pixel):10 + int(y2_pixel), int(img.shape[0]/3):int(img.shape[0]*2/3)] = -1
-    img[int(img.shape[0]/3):int(img.shape[0]*2/3), -10 + int(x1_pixel):10 + int(x1_pixel)] = -1
-    img[int(img.shape[0]/3):int(img.shape[0]*2/3), -10 + int(x2_pixel):10 + int(x2_pixel)] = -1
+    img[-10 + int(y1_pixel):10 + int(y1_pixel), int(img.shape[0]/3):int(img.shape[0]*2/3)] = True
+    img[-10 + int(y2_pixel):10 + int(y2_pixel), int(img.shape[0]/3):int(img.shape[0]*2/3)] = True
+    img[int(img.shape[0]/3):int(img.shape[0]*2/3), -10 + int(x1_pixel):10 + int(x1_pixel)] = True
+    img[int(img.shape[0]/3):int(img.shape[0]*2/3), -10 + int(x2_pixel):10 + int(x2_pixel)] = True
 
     
-    masked_negative = masked_array(img, mask=img >= 0)
+    masked_negative = masked_array(-img.view(np.int8), mask=~img)
 
 
 
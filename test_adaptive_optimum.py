@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from jaw_cal_optimizer import get_adaptive_optimum, get_cost_grid, OffsetTable
+
+def make_offsets(rng, gantry_angles=(0, 50, 130, 180, 230, 310)):
+    #random junction offset table (mm) like get_junc_offsets makes
+    values = rng.normal(0, 0.5, (len(gantry_angles), 2, 4))
+    return OffsetTable(gantry_angles, [0, 90], values=values, iso=np.full((len(gantry_angles), 2), 1190.0))
+
+def make_lrfc(rng, num=2):
+    return [[list(rng.normal(0.3, 0.3, 2)), list(rng.normal(0, 0.4, 4))] for _ in range(num)]
+
+@pytest.mark.parametrize("seed", range(60))
+def test_adaptive_not_worse_than_grid(seed):
+    #the coarse to fine search must never return a worse optimum than the default full grid search
+    rng = np.random.default_rng(seed)
+    offsets = make_offsets(rng)
+    lrfc_vals = make_lrfc(rng) if seed % 2 else None
+    iters = [np.linspace(-0.49, 0.49, n) for n in (31, 31, 21, 21)]
+    grid_cost = np.amin(get_cost_grid(offsets, iters, lrfc_vals=lrfc_vals, junction_priority=0.7))
+
+    opt_offset, opt_cost = get_adaptive_optimum(offsets, [[-0.49, 0.49]]*4, lrfc_vals=lrfc_vals, junction_priority=0.7)
+    assert opt_cost <= grid_cost + 1e-12
+    #the reported cost is the cost at the returned point
+    point_cost = get_cost_grid(offsets, [[shift] for shift in opt_offset], lrfc_vals=lrfc_vals, junction_priority=0.7)[0,0,0,0]
+    assert np.isclose(point_cost, opt_cost)